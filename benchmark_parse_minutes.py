@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from parse_minutes import DEFAULT_PARSER
+from test_parse_minutes import sample_minutes
+
+BASELINE_FILE = 'benchmark_baseline.json'
+
+FIRST_NAMES = [u'Billy', u'Alpha', u'Corene', u'Stella', u'Aubrey', u'Eron', u'Reedie', u'Mae', u'Carmon',
+               u'Lola', u'Josie', u'Ester', u'Ada', u'Elmer', u'Amanda', u'Charley', u'Ted', u'Blanton',
+               u'James', u'Travis', u'Frances Mary', u'Thea', u'Kevin', u'Henry', u'Judy', u'Richard', u'B. B.']
+LAST_NAMES = [u'Williams', u'Black', u'White', u'Pratt', u'Tyree', u'Powell', u'Conwill', u'Brothers',
+              u'Roberson', u'Hocutt', u'Hyde', u'Brown', u'Godsey', u'Denson', u'McCoy', u'Adair', u'Keeton',
+              u'D’Andrea', u'Johansen', u'Bullock', u'Greaves-Lord', u'DeLong', u'Mize', u'van den Berg']
+PROSE = [u'The class was called to order by {name} leading [{page}].',
+         u'{name} offered the opening prayer.',
+         u'The following officers were elected: Chairman - {name}; Secretary - {name2}.',
+         u'The memorial lesson was held by {name}, who spoke of the sick and shut-ins.',
+         u'{name} led {{{page}}} in memory of her father.',
+         u'The closing prayer was offered by {name}.']
+
+def random_name(rng):
+    return rng.choice(FIRST_NAMES) + u' ' + rng.choice(LAST_NAMES)
+
+def random_page(rng):
+    return unicode(rng.randint(26, 560)) + rng.choice([u'', u'', u'', u't', u'b'])
+
+def synthetic_minutes(leads, seed=0):
+    # Generates minutes with roughly `leads` leads, split up into sessions
+    # the same way as real minutes.
+    rng = random.Random(seed)
+    sessions = []
+    while leads > 0:
+        parts = [rng.choice(PROSE).format(name=random_name(rng), name2=random_name(rng), page=random_page(rng))]
+        leaders = []
+        for i in range(min(leads, rng.randint(10, 40))):
+            names = u' and '.join(random_name(rng) for j in range(rng.choice([1, 1, 1, 1, 2])))
+            pages = u', '.join(u'[%s]' % random_page(rng) for j in range(rng.choice([1, 1, 2, 3])))
+            leaders.append(names + u' ' + pages)
+            leads -= 1
+        parts.append(u'Leaders: ' + u'; '.join(leaders) + u'.')
+        parts.append(rng.choice(PROSE).format(name=random_name(rng), name2=random_name(rng), page=random_page(rng)))
+        sessions.append(u' '.join(parts))
+    return rng.choice([u'RECESS', u'LUNCH']).join(sessions)
+
+def build_corpus(sizes):
+    corpus = [('sample %d' % i, s) for (i, s) in enumerate(sample_minutes())]
+    for size in sizes:
+        corpus.append(('synthetic %d' % size, synthetic_minutes(size, seed=size)))
+    return corpus
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    i = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[i]
+
+def time_chunks(parser, s):
+    # Per-chunk latency of the tokenizer (the part of parsing that runs the
+    # name and page number patterns)
+    latencies = []
+    for session in parser.session_pattern.split(s):
+        for chunk in parser.chunk_pattern.split(session):
+            if chunk and len(chunk) > 2:
+                start = time.time()
+                parser.pair_tokens(parser.tokenize(chunk))
+                latencies.append(time.time() - start)
+    return latencies
+
+def run_benchmark(corpus, repeat=3):
+    parser = DEFAULT_PARSER
+    chars = sum(len(s) for (name, s) in corpus)
+
+    # best of `repeat` full passes over the corpus
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for (name, s) in corpus:
+            parser.parse(s)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    latencies = []
+    slowest = []
+    for (name, s) in corpus:
+        start = time.time()
+        latencies.extend(time_chunks(parser, s))
+        slowest.append((time.time() - start, name))
+    slowest.sort(reverse=True)
+
+    return {
+        'minutes': len(corpus),
+        'chars': chars,
+        'chunks': len(latencies),
+        'seconds': best,
+        'chars_per_sec': chars / best,
+        'minutes_per_sec': len(corpus) / best,
+        'chunk_p50_ms': percentile(latencies, 50) * 1000,
+        'chunk_p90_ms': percentile(latencies, 90) * 1000,
+        'chunk_p99_ms': percentile(latencies, 99) * 1000,
+        'chunk_max_ms': max(latencies) * 1000 if latencies else 0.0,
+        'slowest': [[name, seconds] for (seconds, name) in slowest[:5]],
+    }
+
+def print_results(results):
+    print "%d minutes, %d chunks, %d chars in %.3fs" % (results['minutes'], results['chunks'], results['chars'], results['seconds'])
+    print "%12.0f chars/sec" % results['chars_per_sec']
+    print "%12.1f minutes/sec" % results['minutes_per_sec']
+    print "chunk latency (ms): p50 %.3f  p90 %.3f  p99 %.3f  max %.3f" % (
+        results['chunk_p50_ms'], results['chunk_p90_ms'], results['chunk_p99_ms'], results['chunk_max_ms'])
+    print "slowest minutes:"
+    for (name, seconds) in results['slowest']:
+        print "  %-20s %.3fs" % (name, seconds)
+
+def compare_baseline(results, baseline, tolerance):
+    # Returns a list of regressions worse than tolerance (a fraction)
+    regressions = []
+    for key in ('chars_per_sec', 'minutes_per_sec'):
+        if results[key] < baseline[key] * (1 - tolerance):
+            regressions.append("%s: %.1f, baseline %.1f" % (key, results[key], baseline[key]))
+    for key in ('chunk_p50_ms', 'chunk_p90_ms', 'chunk_p99_ms'):
+        if results[key] > baseline[key] * (1 + tolerance):
+            regressions.append("%s: %.3f, baseline %.3f" % (key, results[key], baseline[key]))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark parse_minutes throughput')
+    parser.add_argument('--sizes', default='100,500,2000', help='comma separated lead counts for synthetic minutes')
+    parser.add_argument('--repeat', type=int, default=3, help='number of passes over the corpus (best is reported)')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline results file')
+    parser.add_argument('--save-baseline', action='store_true', help='save these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown vs. the baseline (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    results = run_benchmark(build_corpus(sizes), args.repeat)
+    results['sizes'] = sizes
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+        print "saved baseline to %s" % args.baseline
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('sizes') != sizes:
+            print "baseline was run with different --sizes, not comparing"
+        else:
+            regressions = compare_baseline(results, baseline, args.tolerance)
+            if regressions:
+                print "REGRESSION vs. %s:" % args.baseline
+                for r in regressions:
+                    print "  " + r
+                sys.exit(1)
+            print "no regressions vs. %s" % args.baseline
@@ -1,50 +1,39 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-import csv
 import util
+from csv_loader import load_csv
 
 def delete_aliases(conn):
+    # Not committed here: load_csv commits the new rows in the same
+    # transaction, so a failed load leaves the old aliases in place
     curs = conn.cursor()
     curs.execute("DELETE FROM leader_name_aliases")
     curs.execute("DELETE FROM sqlite_sequence WHERE name='leader_name_aliases'")
-    conn.commit()
     curs.close()
 
-def create_aliases(conn):
-    f =  open('FaSoLa Minutes Corrections (Responses) - Form Responses.csv', 'rb')
-    csvreader = csv.reader(f)
-    curs = conn.cursor()
-    csvreader.next() # skip headers
-    for row in csvreader:
-        curs.execute("INSERT INTO leader_name_aliases (name, alias, type) VALUES (?,?,?)", [row[2], row[1], row[3]])
-    conn.commit()
-    curs.close()
+def create_aliases(conn, path='FaSoLa Minutes Corrections (Responses) - Form Responses.csv'):
+    load_csv(conn, path, ['Uncorrected Name:', 'Correct Name:', 'Is this a typo or alternate spelling?'],
+             "INSERT INTO leader_name_aliases (alias, name, type) VALUES (?,?,?)")
 
 def delete_invalid(conn):
+    # (committed along with create_invalid, like delete_aliases)
     curs = conn.cursor()
     curs.execute("DELETE FROM leader_name_invalid")
     curs.execute("DELETE FROM sqlite_sequence WHERE name='leader_name_invalid'")
-    conn.commit()
     curs.close()
 
-def create_invalid(conn):
-    f =  open('FaSoLa Minutes Corrections (Responses) - Invalid Names.csv', 'rb')
-    csvreader = csv.reader(f)
-    curs = conn.cursor()
-    csvreader.next() # skip headers
-    for row in csvreader:
-        curs.execute("INSERT INTO leader_name_invalid (name) VALUES (?)", [row[1]])
-    conn.commit()
-    curs.close()
+def create_invalid(conn, path='FaSoLa Minutes Corrections (Responses) - Invalid Names.csv'):
+    load_csv(conn, path, ['Uncorrected Name:'], "INSERT INTO leader_name_invalid (name) VALUES (?)")
 
 if __name__ == '__main__':
     db = util.open_db()
 
-    delete_aliases(db)
-    create_aliases(db)
+    with util.bulk_load(db, indexes=()):
+        delete_aliases(db)
+        create_aliases(db)
 
-    delete_invalid(db)
-    create_invalid(db)
+        delete_invalid(db)
+        create_invalid(db)
 
     db.close()
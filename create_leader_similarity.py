@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import argparse
+import numpy
+import util
+
+def create_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS leader_similarity (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            leader_id INTEGER,
+            other_id INTEGER,
+            rank INTEGER,
+            similarity REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS leader_similarity_index ON leader_similarity(leader_id, rank)")
+
+def leader_matrix(conn, min_leads=1):
+    # Returns (leader ids, leader x song matrix of lead counts, with each row
+    # scaled to length 1, so dot products are cosine similarities)
+    rows = conn.execute("""
+        SELECT leader_id, song_id, lead_count FROM leader_song_stats
+        WHERE leader_id IN (SELECT id FROM leaders WHERE lead_count >= ?)
+    """, [min_leads]).fetchall()
+    stats = numpy.array(rows, dtype=numpy.int64).reshape(-1, 3)
+    (leader_ids, leader_index) = numpy.unique(stats[:, 0], return_inverse=True)
+    (song_ids, song_index) = numpy.unique(stats[:, 1], return_inverse=True)
+    # Even with every leader this is only ~10k x ~600 floats
+    counts = numpy.zeros((len(leader_ids), len(song_ids)), dtype=numpy.float32)
+    counts[leader_index, song_index] = stats[:, 2]
+    norms = numpy.sqrt((counts * counts).sum(axis=1))
+    counts /= numpy.maximum(norms, 1e-12)[:, None]
+    return leader_ids, counts
+
+def top_similar(counts, k=20, block_size=1000):
+    # Yields (row, [(other row, similarity), ...]) for every leader's k most
+    # similar leaders, multiplying block_size rows at a time so memory stays
+    # at block_size x leaders
+    k = min(k, len(counts) - 1)
+    if k <= 0:
+        return
+    for start in range(0, len(counts), block_size):
+        sims = counts[start:start + block_size].dot(counts.T)
+        block = numpy.arange(len(sims))
+        sims[block, start + block] = -1  # not yourself
+        top = numpy.argpartition(-sims, k - 1, axis=1)[:, :k]
+        for i in block:
+            others = top[i][numpy.argsort(-sims[i, top[i]], kind='mergesort')]
+            yield start + i, [(j, sims[i, j]) for j in others if sims[i, j] > 0]
+
+def create_stats(conn, k=20, min_leads=1, block_size=1000):
+    (leader_ids, counts) = leader_matrix(conn, min_leads)
+    values = []
+    for (i, similar) in top_similar(counts, k, block_size):
+        for (rank, (j, similarity)) in enumerate(similar):
+            values.append((int(leader_ids[i]), int(leader_ids[j]), rank + 1, float(similarity)))
+    conn.executemany("INSERT INTO leader_similarity (leader_id, other_id, rank, similarity) VALUES (?,?,?,?)", values)
+    conn.commit()
+    print "created %d leader_similarity records" % len(values)
+
+def delete_stats(conn):
+    curs = conn.cursor()
+    curs.execute("DELETE FROM leader_similarity")
+    curs.execute("DELETE FROM sqlite_sequence WHERE name='leader_similarity'")
+    conn.commit()
+    curs.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the leaders with the most similar repertoire to each leader')
+    parser.add_argument('-k', type=int, default=20, help='similar leaders to keep per leader')
+    parser.add_argument('--min-leads', type=int, default=1, help='skip leaders with fewer leads than this')
+    parser.add_argument('--block-size', type=int, default=1000, help='leaders to compare at once')
+    args = parser.parse_args()
+
+    db = util.open_db()
+    with util.bulk_load(db, indexes=()):
+        create_table(db)
+        delete_stats(db)
+        create_stats(db, args.k, args.min_leads, args.block_size)
+    db.close()
@@ -1,31 +1,39 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-import time
-from numpy import array, log2
-from collections import defaultdict
+import argparse
+import numpy
 import util
 
-def count_total_leads(leader_id, counts):
-    lc = array(counts, dtype=float)
-    lcnorm = lc / sum(lc)
-    lead_count = sum(lc)
-    song_entropy = sum(lcnorm * log2(lcnorm)) / -9.1137421660491889
-    return lead_count, song_entropy
+def count_total_leads(leader_ids, counts, song_count):
+    # leader_ids and counts are parallel arrays, sorted by leader_id. Returns
+    # (leader ids, lead counts, song entropies), one entry per leader. Song
+    # entropy is the entropy of a leader's songs normalized by the entropy of
+    # leading every song equally often.
+    if not len(leader_ids):
+        return leader_ids, counts, numpy.zeros(0)
+    counts = counts.astype(float)
+    starts = numpy.flatnonzero(numpy.r_[True, leader_ids[1:] != leader_ids[:-1]])
+    lead_counts = numpy.add.reduceat(counts, starts)
+    p = counts / numpy.repeat(lead_counts, numpy.diff(numpy.r_[starts, len(counts)]))
+    song_entropy = numpy.add.reduceat(p * numpy.log2(p), starts) / -numpy.log2(song_count)
+    return leader_ids[starts], lead_counts, song_entropy
 
-def create_counts(conn):
+def create_counts(conn, changed_only=False):
+    # With changed_only, just the leaders in changed_pairs (see update_stats)
     curs = conn.cursor()
 
-    # Read all leader_song_stats at once
-    all_stats = defaultdict(list)
-    for (id, count) in curs.execute("SELECT leader_id, lead_count FROM leader_song_stats"):
-        all_stats[id].append(count)
+    song_count = curs.execute("SELECT COUNT(*) FROM songs").fetchone()[0]
+    where = "WHERE leader_id IN (SELECT leader_id FROM changed_pairs)" if changed_only else ""
+    rows = curs.execute("SELECT leader_id, lead_count FROM leader_song_stats %s ORDER BY leader_id" % where).fetchall()
+    stats = numpy.array(rows, dtype=numpy.int64).reshape(-1, 2)
+    # (at least 2 songs, since the normalizer is log2(song_count))
+    (leader_ids, lead_counts, song_entropy) = count_total_leads(stats[:, 0], stats[:, 1], max(song_count, 2))
 
-    for (id, counts) in all_stats.items():
-        lead_count, song_entropy = count_total_leads(id, counts)
-        curs.execute("UPDATE leaders SET lead_count=?, song_entropy=? WHERE id=?", [lead_count, song_entropy, id])
+    curs.executemany("UPDATE leaders SET lead_count=?, song_entropy=? WHERE id=?",
+                     zip(lead_counts.astype(int).tolist(), song_entropy.tolist(), leader_ids.tolist()))
 
-    print "updated %d leaders records" % len(all_stats)
+    print "updated %d leaders records" % len(leader_ids)
     conn.commit()
     curs.close()
 
@@ -42,6 +50,32 @@ def create_stats(conn):
     conn.commit()
     curs.close()
 
+def update_stats(conn, pairs):
+    # Recounts leader_song_stats for just these (leader_id, song_id) pairs,
+    # which are left in the changed_pairs temp table
+    curs = conn.cursor()
+    curs.execute("DROP TABLE IF EXISTS temp.changed_pairs")
+    curs.execute("CREATE TEMP TABLE changed_pairs (leader_id INTEGER, song_id INTEGER, PRIMARY KEY (leader_id, song_id))")
+    curs.executemany("INSERT OR IGNORE INTO changed_pairs (leader_id, song_id) VALUES (?, ?)", pairs)
+    curs.execute("""
+        DELETE FROM leader_song_stats WHERE EXISTS (
+            SELECT 1 FROM changed_pairs
+            WHERE changed_pairs.leader_id = leader_song_stats.leader_id
+            AND changed_pairs.song_id = leader_song_stats.song_id
+        )
+    """)
+    curs.execute("""
+        INSERT INTO leader_song_stats (leader_id, song_id, lead_count)
+        SELECT j.leader_id, j.song_id, COUNT(*) as count
+        FROM changed_pairs
+        JOIN song_leader_joins j ON j.leader_id = changed_pairs.leader_id AND j.song_id = changed_pairs.song_id
+        GROUP BY j.leader_id, j.song_id
+        ORDER BY j.leader_id, count DESC
+    """)
+    print "updated %d leader_song_stats records" % curs.rowcount
+    conn.commit()
+    curs.close()
+
 def delete_stats(conn):
     curs = conn.cursor()
     curs.execute("DELETE FROM leader_song_stats")
@@ -50,8 +84,20 @@ def delete_stats(conn):
     curs.close()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--delta', action='store_true', help='only update stats for joins that changed since the last run')
+    args = parser.parse_args()
+
     db = util.open_db()
-    delete_stats(db)
-    create_stats(db)
-    create_counts(db)
+    with util.bulk_load(db, indexes=()):
+        (last_change, changes) = util.read_stats_changes(db, 'leader_stats')
+        if args.delta and changes is not None:
+            update_stats(db, [(leader_id, song_id) for (leader_id, song_id, year) in changes])
+            create_counts(db, changed_only=True)
+        else:
+            delete_stats(db)
+            create_stats(db)
+            create_counts(db)
+        util.finish_stats_changes(db, 'leader_stats', last_change)
     db.close()
+
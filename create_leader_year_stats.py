@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import util
+
+# Summary columns on leaders, filled in from leader_year_stats
+LEADER_COLUMNS = [
+    ('first_year', 'INTEGER'),
+    ('last_year', 'INTEGER'),
+    ('active_years', 'INTEGER'),
+    ('singing_count', 'INTEGER'),
+]
+
+def create_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS leader_year_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            leader_id INTEGER,
+            year INTEGER,
+            lead_count INTEGER,
+            song_count INTEGER,
+            singing_count INTEGER,
+            rank INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS leader_year_stats_leader_index ON leader_year_stats(leader_id, year)")
+    conn.execute("CREATE INDEX IF NOT EXISTS leader_year_stats_year_index ON leader_year_stats(year, rank)")
+    existing = set(row[1] for row in conn.execute("PRAGMA table_info(leaders)"))
+    for (name, type) in LEADER_COLUMNS:
+        if name not in existing:
+            conn.execute("ALTER TABLE leaders ADD COLUMN %s %s" % (name, type))
+
+def create_stats(conn):
+    # One pass over song_leader_joins: leads, distinct songs and singings per
+    # leader per year, with leaders ranked (1, 2, 2, 4, ...) by leads in
+    # each year like song_stats
+    curs = conn.cursor()
+    curs.execute("""
+        INSERT INTO leader_year_stats (leader_id, year, lead_count, song_count, singing_count, rank)
+        SELECT leader_id, minutes.Year, COUNT(*) AS count, COUNT(DISTINCT song_id), COUNT(DISTINCT minutes_id),
+               RANK() OVER (PARTITION BY minutes.Year ORDER BY COUNT(*) DESC)
+        FROM song_leader_joins
+        JOIN minutes ON song_leader_joins.minutes_id = minutes.id
+        GROUP BY minutes.Year, leader_id
+        ORDER BY minutes.Year, count DESC, leader_id
+    """)
+    print "created %d leader_year_stats records" % curs.rowcount
+    conn.commit()
+    curs.close()
+
+def create_summary(conn):
+    # Each minutes row has one year, so summing singings over years counts
+    # every singing once
+    curs = conn.cursor()
+    curs.execute("""
+        UPDATE leaders SET (first_year, last_year, active_years, singing_count) = (
+            SELECT MIN(year), MAX(year), COUNT(year), SUM(singing_count)
+            FROM leader_year_stats WHERE leader_year_stats.leader_id = leaders.id
+        )
+    """)
+    print "updated %d leaders records" % curs.rowcount
+    conn.commit()
+    curs.close()
+
+def delete_stats(conn):
+    curs = conn.cursor()
+    curs.execute("DELETE FROM leader_year_stats")
+    curs.execute("DELETE FROM sqlite_sequence WHERE name='leader_year_stats'")
+    conn.commit()
+    curs.close()
+
+if __name__ == '__main__':
+    db = util.open_db()
+    with util.bulk_load(db, indexes=()):
+        create_tables(db)
+        delete_stats(db)
+        create_stats(db)
+        create_summary(db)
+    db.close()
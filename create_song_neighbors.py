@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import argparse
+import numpy
+import util
+
+def create_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS song_neighbors (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            song_id INTEGER,
+            neighbor_id INTEGER,
+            rank INTEGER,
+            singing_count INTEGER,
+            lift REAL,
+            pmi REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS song_neighbors_index ON song_neighbors(song_id, rank)")
+
+def song_matrix(conn):
+    # Returns (song ids, minutes x song matrix of 0/1 for "was led at")
+    rows = conn.execute("SELECT DISTINCT minutes_id, song_id FROM song_leader_joins").fetchall()
+    pairs = numpy.array(rows, dtype=numpy.int64).reshape(-1, 2)
+    (minutes_ids, minutes_index) = numpy.unique(pairs[:, 0], return_inverse=True)
+    (song_ids, song_index) = numpy.unique(pairs[:, 1], return_inverse=True)
+    # There are only a few hundred songs, so a dense matrix is small, and
+    # much faster to multiply than a sparse one
+    led = numpy.zeros((len(minutes_ids), len(song_ids)), dtype=numpy.float32)
+    led[minutes_index, song_index] = 1
+    return song_ids, led
+
+def top_neighbors(led, k=20, min_count=3):
+    # Returns (neighbors, counts, lift) arrays of shape (songs, k): each
+    # song's k songs with the highest lift that were led at the same singing
+    # at least min_count times. Missing neighbors are -1.
+    together = led.T.dot(led).astype(numpy.float64)  # singings with both songs
+    singings = numpy.diag(together).copy()           # singings with each song
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        lift = together * len(led) / numpy.outer(singings, singings)
+    score = numpy.where(together >= min_count, lift, -numpy.inf)
+    numpy.fill_diagonal(score, -numpy.inf)
+
+    k = min(k, max(len(score) - 1, 0))
+    top = numpy.argsort(-score, axis=1, kind='mergesort')[:, :k]
+    rows = numpy.arange(len(score))[:, None]
+    neighbors = numpy.where(numpy.isfinite(score[rows, top]), top, -1)
+    return neighbors, together[rows, top], lift[rows, top]
+
+def create_stats(conn, k=20, min_count=3):
+    (song_ids, led) = song_matrix(conn)
+    (neighbors, counts, lift) = top_neighbors(led, k, min_count)
+    values = []
+    for i in range(len(neighbors)):
+        for rank in range(neighbors.shape[1]):
+            j = neighbors[i, rank]
+            if j < 0:
+                break
+            values.append((int(song_ids[i]), int(song_ids[j]), rank + 1, int(counts[i, rank]),
+                           float(lift[i, rank]), float(numpy.log2(lift[i, rank]))))
+    conn.executemany("INSERT INTO song_neighbors (song_id, neighbor_id, rank, singing_count, lift, pmi) VALUES (?,?,?,?,?,?)", values)
+    conn.commit()
+    print "created %d song_neighbors records" % len(values)
+
+def delete_stats(conn):
+    curs = conn.cursor()
+    curs.execute("DELETE FROM song_neighbors")
+    curs.execute("DELETE FROM sqlite_sequence WHERE name='song_neighbors'")
+    conn.commit()
+    curs.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the songs most often led at the same singings as each song')
+    parser.add_argument('-k', type=int, default=20, help='neighbors to keep per song')
+    parser.add_argument('--min-count', type=int, default=3, help='ignore pairs of songs led together at fewer singings than this')
+    args = parser.parse_args()
+
+    db = util.open_db()
+    with util.bulk_load(db, indexes=()):
+        create_table(db)
+        delete_stats(db)
+        create_stats(db, args.k, args.min_count)
+    db.close()
@@ -1,50 +1,110 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-from collections import defaultdict
+import argparse
 import util
 
-def build_ranks(conn):
-    # ranks[year] = sorted [(count, song_id), ...]
-    ranks = defaultdict(list)
-    cursor = conn.execute("""
-        SELECT song_id, COUNT(*), minutes.Year
+LOCATION_JOINS = """
+    JOIN minutes_location_joins ON minutes_location_joins.minutes_id = minutes.id
+    JOIN locations ON minutes_location_joins.location_id = locations.id
+"""
+
+# Song popularity tables: table -> ([(column, expression), ...], extra joins).
+# Each counts song_leader_joins by song and the other columns, and ranks
+# songs within each group of the other columns.
+STATS_TABLES = [
+    ('song_stats', [('year', 'minutes.Year')], ''),
+    ('song_state_stats', [('state', 'locations.state_province'), ('year', 'minutes.Year')], LOCATION_JOINS),
+    ('song_location_stats', [('location_id', 'locations.id'), ('year', 'minutes.Year')], LOCATION_JOINS),
+]
+
+def create_tables(conn):
+    # song_stats already exists; the regional tables are indexed for "top
+    # songs in GA in 2015" lookups
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS song_state_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            song_id INTEGER,
+            state TEXT,
+            year INTEGER,
+            lead_count INTEGER,
+            rank INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS song_state_stats_index ON song_state_stats(state, year, rank)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS song_location_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            song_id INTEGER,
+            location_id INTEGER,
+            year INTEGER,
+            lead_count INTEGER,
+            rank INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS song_location_stats_index ON song_location_stats(location_id, year, rank)")
+
+def create_stats(conn, table='song_stats', years=None):
+    # Counts and ranks (1, 2, 2, 4, ...) songs, for all years or just `years`
+    (columns, joins) = [(c, j) for (t, c, j) in STATS_TABLES if t == table][0]
+    names = ', '.join(name for (name, expr) in columns)
+    exprs = ', '.join(expr for (name, expr) in columns)
+    where = ""
+    if years is not None:
+        where = "WHERE minutes.Year IN (%s)" % ','.join('?' * len(years))
+    # (a singing with two locations in one state would count twice)
+    count = "COUNT(DISTINCT song_leader_joins.id)" if joins else "COUNT(*)"
+    curs = conn.cursor()
+    curs.execute("""
+        INSERT INTO %(table)s (song_id, %(names)s, lead_count, rank)
+        SELECT song_id, %(exprs)s, %(count)s AS count,
+               RANK() OVER (PARTITION BY %(exprs)s ORDER BY %(count)s DESC)
         FROM song_leader_joins
         JOIN minutes ON song_leader_joins.minutes_id = minutes.id
-        GROUP BY minutes.Year, song_id
-        ORDER BY minutes.Year ASC, COUNT(*) DESC, song_id ASC
-    """)
-    for (song_id, count, year) in cursor:
-        ranks[year].append((count, song_id))
-    return ranks
-
-def create_stats(conn):
-    ranks = build_ranks(conn)
-    # values = [(song_id, year, lead_count, rank), ...]
-    values = []
-    for year in sorted(ranks.keys()):
-        rank = 1
-        last_count = 0
-        for i, (count, song_id) in enumerate(ranks[year]):
-            if count != last_count:
-                rank = i + 1
-            last_count = count
-            values.append((song_id, year, count, rank))
-
-    conn.executemany("INSERT INTO song_stats (song_id, year, lead_count, rank) VALUES (?, ?, ?, ?)", values)
+        %(joins)s
+        %(where)s
+        GROUP BY %(exprs)s, song_id
+        ORDER BY %(exprs)s, count DESC, song_id
+    """ % locals(), list(years or []))
     conn.commit()
-    print "created %d song_stats records" % len(values)
+    print "created %d %s records" % (curs.rowcount, table)
+    curs.close()
 
+def update_stats(conn, years):
+    # Re-counts and re-ranks just these years
+    years = sorted(years)
+    conn.executemany("DELETE FROM song_stats WHERE year=?", [(year,) for year in years])
+    create_stats(conn, 'song_stats', years)
 
-def delete_stats(conn):
+def delete_stats(conn, table='song_stats'):
     curs = conn.cursor()
-    curs.execute("DELETE FROM song_stats")
-    curs.execute("DELETE FROM sqlite_sequence WHERE name='song_stats'")
+    curs.execute("DELETE FROM %s" % table)
+    curs.execute("DELETE FROM sqlite_sequence WHERE name=?", [table])
     conn.commit()
     curs.close()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--delta', action='store_true', help='only update the song_stats years whose joins changed since the last run')
+    args = parser.parse_args()
+
     db = util.open_db()
-    delete_stats(db)
-    create_stats(db)
+    with util.bulk_load(db, indexes=()):
+        (last_change, changes) = util.read_stats_changes(db, 'song_stats')
+        years = set(year for (leader_id, song_id, year) in changes or [])
+        # (joins from deleted minutes have no year, so we can't tell which
+        # years they were in)
+        if args.delta and changes is not None and None not in years:
+            update_stats(db, years)
+        else:
+            delete_stats(db)
+            create_stats(db)
+        util.finish_stats_changes(db, 'song_stats', last_change)
+
+        # The regional tables also depend on insert_locations.py, which
+        # doesn't log changes, so they're always rebuilt
+        create_tables(db)
+        for (table, columns, joins) in STATS_TABLES[1:]:
+            delete_stats(db, table)
+            create_stats(db, table)
     db.close()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import csv
+import time
+
+class CsvLoader(object):
+    """Streams rows from a CSV file into the database.
+
+    `columns` picks the values rows() yields, by header name, or by column
+    number for files whose header names aren't fixed. Missing header names
+    are an error up front; rows that are too short (or that a transform
+    rejects with ValueError) are counted as errors and skipped. Statements
+    queued with execute() go through executemany in batches of batch_size,
+    and everything is committed once at the end of load(), or rolled back if
+    loading fails.
+    """
+
+    max_errors_shown = 10
+
+    def __init__(self, conn, path, columns, delimiter=',', batch_size=1000):
+        self.conn = conn
+        self.path = path
+        self.columns = columns
+        self.delimiter = delimiter
+        self.batch_size = batch_size
+        self.rows_read = 0
+        self.rows_written = 0
+        self.errors = 0
+        self.skipped = 0
+        self.seconds = 0.0
+        self.line = None
+        self.pending_sql = None
+        self.pending = []
+
+    def column_indexes(self, header):
+        names = [name.strip().strip('"').strip() for name in header]
+        indexes = []
+        missing = []
+        for column in self.columns:
+            if isinstance(column, int):
+                if column >= len(names):
+                    missing.append('#%d' % column)
+                indexes.append(column)
+            elif column in names:
+                indexes.append(names.index(column))
+            else:
+                missing.append(column)
+        if missing:
+            raise ValueError("%s is missing columns: %s (found %s)" % (self.path, ', '.join(missing), ', '.join(names)))
+        return indexes
+
+    def rows(self):
+        # Yields a tuple of the selected columns for every row
+        with open(self.path, 'rb') as f:
+            reader = csv.reader(f, delimiter=self.delimiter)
+            indexes = self.column_indexes(reader.next())
+            width = max(indexes) + 1 if indexes else 0
+            for row in reader:
+                self.rows_read += 1
+                if len(row) < width:
+                    self.error("expected %d columns, found %d" % (width, len(row)), reader.line_num)
+                    continue
+                self.line = reader.line_num
+                yield tuple(row[i] for i in indexes)
+
+    def error(self, message, line=None):
+        self.errors += 1
+        if self.errors <= self.max_errors_shown:
+            print "%s:%s: %s" % (self.path, line or self.line or '?', message)
+
+    def execute(self, sql, params):
+        # Queues a statement for executemany
+        if sql != self.pending_sql:
+            self.flush()
+            self.pending_sql = sql
+        self.pending.append(params)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.conn.executemany(self.pending_sql, self.pending)
+            self.rows_written += len(self.pending)
+        self.pending = []
+
+    def load(self, sql=None, transform=None):
+        # Runs `sql` with every row (or with transform(row), skipping rows
+        # it returns None for), in one transaction. A transform can also
+        # call execute() itself.
+        start = time.time()
+        try:
+            for row in self.rows():
+                try:
+                    params = transform(row) if transform else row
+                except ValueError as e:
+                    self.error(e)
+                    continue
+                if params is None:
+                    self.skipped += 1
+                elif sql:
+                    self.execute(sql, params)
+            self.flush()
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            self.seconds = time.time() - start
+        print self.report()
+        return self
+
+    def report(self):
+        return "%s: %d rows, %d written, %d skipped, %d errors in %.2fs (%.0f rows/s)" % (
+            self.path, self.rows_read, self.rows_written, self.skipped, self.errors,
+            self.seconds, self.rows_read / max(self.seconds, 1e-6))
+
+def load_csv(conn, path, columns, sql, transform=None, delimiter=',', batch_size=1000):
+    return CsvLoader(conn, path, columns, delimiter, batch_size).load(sql, transform)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import argparse
+import csv
+import difflib
+import imp
+import itertools
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import util
+import parse_minutes
+
+# The two parse functions being compared. These are set before the pool is
+# created, so the (forked) workers inherit them.
+PARSERS = {}
+
+def load_parser(version, name):
+    # Returns the parse_minutes function from `version`, which is either a
+    # path to a parse_minutes.py, a git revision, or None for this checkout.
+    if version is None:
+        return parse_minutes.parse_minutes
+    if os.path.isfile(version):
+        with open(version) as f:
+            source = f.read()
+    else:
+        here = os.path.dirname(os.path.abspath(__file__))
+        source = subprocess.check_output(['git', 'show', '%s:parse_minutes.py' % version], cwd=here)
+    module = imp.new_module(name)
+    module.__file__ = '<%s:parse_minutes.py>' % version
+    sys.modules[name] = module
+    exec compile(source, module.__file__, 'exec') in module.__dict__
+    return module.parse_minutes
+
+def leads(d):
+    return [(leader['name'], leader['song']) for session in d for leader in session['leaders']]
+
+def diff_minutes(row):
+    # Returns (minutes_id, name, date, old lead count, new lead count, added, removed, [change, ...])
+    (s, name, date, minutes_id) = row
+    old = leads(PARSERS['old'](s))
+    new = leads(PARSERS['new'](s))
+    if old == new:
+        return (minutes_id, name, date, len(old), len(new), 0, 0, [])
+    added = removed = 0
+    changes = []
+    matcher = difflib.SequenceMatcher(a=old, b=new, autojunk=False)
+    for (tag, i1, i2, j1, j2) in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        removed += i2 - i1
+        added += j2 - j1
+        for lead in old[i1:i2]:
+            changes.append(u'-%s [%s]' % lead)
+        for lead in new[j1:j2]:
+            changes.append(u'+%s [%s]' % lead)
+    return (minutes_id, name, date, len(old), len(new), added, removed, changes)
+
+def diff_all_minutes(conn, workers=1):
+    # Returns (number of minutes compared, [(minutes_id, name, date, old leads,
+    # new leads, added, removed, changes), ...]) with a row for every Denson
+    # minutes row whose leads changed, most changed first.
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        imap = lambda f, rows: pool.imap_unordered(f, rows, chunksize=8)
+    else:
+        imap = itertools.imap
+
+    changed = []
+    total = 0
+    try:
+        # one batch at a time, so the pool never holds every minutes text
+        for rows in parse_minutes.read_minutes(conn):
+            for result in imap(diff_minutes, rows):
+                total += 1
+                if result[5] or result[6]:
+                    changed.append(result)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    changed.sort(key=lambda c: (-(c[5] + c[6]), c[0]))
+    return total, changed
+
+def write_report(path, changed, max_changes=20):
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['minutes_id', 'name', 'date', 'old_leads', 'new_leads', 'added', 'removed', 'changes'])
+        for (minutes_id, name, date, old_count, new_count, added, removed, changes) in changed:
+            shown = changes[:max_changes] + (['...'] if len(changes) > max_changes else [])
+            writer.writerow([minutes_id, name.encode('utf-8'), date.encode('utf-8'), old_count, new_count,
+                             added, removed, u'; '.join(shown).encode('utf-8')])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the leads found by two versions of parse_minutes.py across every minutes row')
+    parser.add_argument('old', help='old parse_minutes.py: a git revision or a path to the file')
+    parser.add_argument('new', nargs='?', help='new parse_minutes.py (default: this checkout)')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='number of parser processes')
+    parser.add_argument('--out', default='parser_diff.csv', help='report file')
+    args = parser.parse_args()
+
+    PARSERS['old'] = load_parser(args.old, 'parse_minutes_old')
+    PARSERS['new'] = load_parser(args.new, 'parse_minutes_new')
+
+    start = time.time()
+    db = util.open_db()
+    (total, changed) = diff_all_minutes(db, args.workers)
+    db.close()
+
+    write_report(args.out, changed)
+    print "%d of %d minutes changed (+%d -%d leads) in %.1fs, report in %s" % (
+        len(changed), total, sum(c[5] for c in changed), sum(c[6] for c in changed), time.time() - start, args.out)
+    for (minutes_id, name, date, old_count, new_count, added, removed, changes) in changed[:10]:
+        print "  %6d  +%-4d -%-4d %s on %s" % (minutes_id, added, removed, name, date)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import argparse
+import io
+import os
+import random
+import time
+from benchmark_parse_minutes import build_corpus
+from parse_minutes import DEFAULT_PARSER, ParsePool, TIMED_OUT
+
+# Bits of text that exercise the name pattern: initials, lower case names
+# that contain upper case, "van den", bad word prefixes and so on.
+TOKENS = [u'A. ', u'B.', u'J. R. ', u'van den ', u'Van den ', u'Chair', u'Chairman ', u'for ', u'McCoy ',
+          u'deLong ', u'aB', u'D’', u'’', u'-', u'Greaves-Lord ', u'É', u'Ödön ', u' ', u'  ', u'.', u'. ',
+          u'[123]', u'{45t}', u' 67b', u'/89', u'(ACH)', u'Smith', u'x', u'1']
+
+def time_parse(s, repeat=3):
+    # Best of `repeat` parses, in seconds. Returns (seconds, None) so it can
+    # go through ParsePool, which uses (None, None) for a timeout.
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        DEFAULT_PARSER.parse_compact(s)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, None
+
+def seed_inputs(rng, count, length):
+    # Chunks of the benchmark corpus, plus a few generated worst cases for
+    # the nested repetition in the name pattern
+    seeds = []
+    for (name, s) in build_corpus([200]):
+        for session in DEFAULT_PARSER.session_pattern.split(s):
+            seeds.extend(c for c in DEFAULT_PARSER.chunk_pattern.split(session) if c and len(c) > 2)
+    seeds = rng.sample(seeds, min(count, len(seeds)))
+    for token in (u'A. ', u'aB ', u'van den ', u'Chair ', u'Ab-', u'A’'):
+        seeds.append(token * (length // len(token)) + u' [123]')
+    return seeds
+
+def mutate(rng, s, length):
+    op = rng.randrange(4)
+    i = rng.randrange(len(s) + 1)
+    if op == 0:
+        # insert an interesting token
+        s = s[:i] + rng.choice(TOKENS) + s[i:]
+    elif op == 1:
+        # repeat a span
+        j = min(len(s), i + rng.randint(1, 20))
+        s = s[:j] + s[i:j] * rng.randint(2, 10) + s[j:]
+    elif op == 2:
+        # delete a span
+        s = s[:i] + s[i + rng.randint(1, 10):]
+    else:
+        # splice with a random token run
+        s = s[:i] + u''.join(rng.choice(TOKENS) for k in range(rng.randint(2, 20))) + s[i:]
+    return s[:length]
+
+def cost(seconds, s):
+    # Slowness per character, so long inputs don't win just by being long
+    # (and tiny inputs don't win on fixed overhead)
+    return seconds / max(len(s), 200)
+
+def fuzz(iterations, population, length, time_budget, workers, seed, out_dir):
+    rng = random.Random(seed)
+    pool = ParsePool(workers, time_budget)
+    hangs = []
+    try:
+        candidates = seed_inputs(rng, population * 4, length)
+        scored = []
+        for generation in range(iterations):
+            results = pool.imap(time_parse, candidates)
+            for (s, result) in zip(candidates, results):
+                if result is TIMED_OUT:
+                    hangs.append(s)
+                    save_input(out_dir, 'hang', len(hangs), s)
+                    print "HANG (>%gs) on %d chars" % (time_budget, len(s))
+                else:
+                    scored.append((cost(result[0], s), result[0], s))
+            # keep the slowest inputs found so far, and mutate them
+            scored.sort(reverse=True)
+            scored = scored[:population]
+            if scored:
+                print "generation %d: slowest %.2f us/char (%.4fs on %d chars)" % (
+                    generation, scored[0][0] * 1e6, scored[0][1], len(scored[0][2]))
+            # (if every input so far hung, carry on from the hangs instead)
+            parents = [s for (c, seconds, s) in scored] or hangs or candidates
+            candidates = [mutate(rng, rng.choice(parents), length) for i in range(population * 2)]
+    finally:
+        pool.close()
+
+    for (i, (c, seconds, s)) in enumerate(scored[:10]):
+        save_input(out_dir, 'slow', i + 1, s)
+    return scored, hangs
+
+def save_input(out_dir, kind, i, s):
+    if not out_dir:
+        return
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    with io.open(os.path.join(out_dir, '%s-%03d.txt' % (kind, i)), 'w', encoding='utf-8') as f:
+        f.write(s)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search for minutes text that makes the parser regexes slow')
+    parser.add_argument('--iterations', type=int, default=50, help='number of generations')
+    parser.add_argument('--population', type=int, default=20, help='number of slow inputs to keep and mutate')
+    parser.add_argument('--length', type=int, default=2000, help='maximum input length in characters')
+    parser.add_argument('--time-budget', type=float, default=2.0, metavar='SECONDS', help='inputs slower than this are reported as hangs')
+    parser.add_argument('--workers', type=int, default=1, help='number of parser processes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='fuzz_output', help='directory to save the slowest inputs and hangs to')
+    args = parser.parse_args()
+
+    (scored, hangs) = fuzz(args.iterations, args.population, args.length, args.time_budget, args.workers, args.seed, args.out)
+
+    print "slowest inputs:"
+    for (c, seconds, s) in scored[:10]:
+        print "  %8.2f us/char  %.4fs  %r" % (c * 1e6, seconds, s[:60])
+    print "%d hangs" % len(hangs)
@@ -2,40 +2,51 @@
 # encoding: utf-8
 
 import re
-import csv
 import googlemaps
 import util
+from csv_loader import CsvLoader
 
 def delete_locations(conn):
+    # Not committed here: the loader commits the new rows in the same
+    # transaction, so a failed load leaves the old locations in place
     curs = conn.cursor()
     curs.execute("DELETE FROM locations")
     curs.execute("DELETE FROM minutes_location_joins")
-    conn.commit()
     curs.close()
 
-def insert_locations(conn):
-    f =  open('Singings Locations Fuzzy - locations_for_export.csv', 'rb')
-    csvreader = csv.reader(f)
+LOCATION_COLUMNS = ['minutes_id', 'name', 'address', 'lat_long', 'url', 'notes', 'address1', 'city', 'county',
+                    'state_province', 'postal_code', 'country']
+
+def insert_locations(conn, path='Singings Locations Fuzzy - locations_for_export.csv'):
+    loader = CsvLoader(conn, path, LOCATION_COLUMNS)
     curs = conn.cursor()
-    csvreader.next() #headers
-    for row in csvreader:
-        # multilocation_day_id,minutes_id,name,address,lat_long,url,notes,gps_lat,gps_long,address1,city,county,state_province,postal_code,country
-        name = row[2]
-        address = row[3]
-        lat_long = row[4]
-        url = row[5]
-        notes = row[6]
+    # (gps_lat, gps_long) or name -> location id, so repeated locations don't
+    # need a query
+    location_ids = {}
+
+    def find_location(key, query, params):
+        if key not in location_ids:
+            curs.execute(query, params)
+            location_row = curs.fetchone()
+            location_ids[key] = location_row and location_row[0]
+        return location_ids[key]
+
+    def insert_location(key, query, params):
+        curs.execute(query, params)
+        location_ids[key] = curs.lastrowid
+        return curs.lastrowid
+
+    def insert_row(row):
+        (minutes_id, name, address, lat_long, url, notes) = row[:6]
 
         location_id = 0
 
         if len(lat_long) > 0:
             gps = [a.strip() for a in lat_long.split(',')]
             # print gps
-            if len(gps) == 2:
-                gps_lat = gps[0]
-                gps_long = gps[1]
-            # else:
-            #     print 'bad gps'
+            if len(gps) != 2:
+                raise ValueError('bad gps: %s' % lat_long)
+            (gps_lat, gps_long) = gps
 
             address1 = None
             if len(address) > 0:
@@ -51,39 +62,26 @@ def insert_locations(conn):
                     print "weird address?? %s" % address
 
             if address1 is None:
-                address1 = row[9]
-                city = row[10]
-                county = row[11]
-                state_province = row[12]
-                postal_code = row[13]
-                country = row[14]
+                (address1, city, county, state_province, postal_code, country) = row[6:]
 
             print "%s - %s - %s - %s - %s - %s - %s - %s - %s" % (name, url, notes, gps_lat, gps_long, address1, city, county, state_province)
 
-            curs.execute("SELECT id FROM locations WHERE gps_lat=? AND gps_long=?", [gps_lat,gps_long])
-            location_row = curs.fetchone()
-            if location_row is None:
-                curs.execute("INSERT INTO locations (name, url, notes, gps_lat, gps_long, address, city, county, state_province, postal_code, country) VALUES (?,?,?,?,?,?,?,?,?,?,?)", [name, url, notes, gps_lat, gps_long, address1, city, county, state_province, postal_code, country])
-                location_id = curs.lastrowid
-            else:
-                location_id = location_row[0]
+            key = (gps_lat, gps_long)
+            location_id = find_location(key, "SELECT id FROM locations WHERE gps_lat=? AND gps_long=?", [gps_lat,gps_long])
+            if location_id is None:
+                location_id = insert_location(key, "INSERT INTO locations (name, url, notes, gps_lat, gps_long, address, city, county, state_province, postal_code, country) VALUES (?,?,?,?,?,?,?,?,?,?,?)", [name, url, notes, gps_lat, gps_long, address1, city, county, state_province, postal_code, country])
         else:
             print 'no gps?!'
 
-            curs.execute("SELECT id FROM locations WHERE name=?", [name])
-            location_row = curs.fetchone()
-            location_id = 0
-            if location_row is None:
-                curs.execute("INSERT INTO locations (name, url, notes) VALUES (?,?,?)", [name, url, notes])
-                location_id = curs.lastrowid
-            else:
-                location_id = location_row[0]
+            location_id = find_location(name, "SELECT id FROM locations WHERE name=?", [name])
+            if location_id is None:
+                location_id = insert_location(name, "INSERT INTO locations (name, url, notes) VALUES (?,?,?)", [name, url, notes])
 
         if location_id > 0:
-            minutes_id = row[1]
-            curs.execute("INSERT INTO minutes_location_joins (minutes_id, location_id) VALUES (?,?)", [minutes_id, location_id])
+            loader.execute("INSERT INTO minutes_location_joins (minutes_id, location_id) VALUES (?,?)", [minutes_id, location_id])
+        return location_id or None
 
-    conn.commit()
+    loader.load(transform=insert_row)
     curs.close()
 
 def find_counties(conn):
@@ -118,7 +116,8 @@ def find_counties(conn):
 
 if __name__ == '__main__':
     db = util.open_db()
-    delete_locations(db)
-    insert_locations(db)
+    with util.bulk_load(db, indexes=()):
+        delete_locations(db)
+        insert_locations(db)
     # find_counties(db)
     db.close()
@@ -1,30 +1,27 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-import csv
 import util
+from csv_loader import load_csv
+
+# Columns of Minutes_All.txt, in order
+MINUTES_COLUMNS = ['Name', 'Location', 'Date', 'Minutes', 'Year', 'IsDenson', 'GoodCt', 'ErrCt', 'AmbCt',
+                   'CorrCt', 'ProbCt', 'TotalCt', 'ProbPercent']
 
 def delete_minutes(conn):
+    # Not committed here: load_csv commits the new rows in the same
+    # transaction, so a failed load leaves the old minutes in place
     curs = conn.cursor()
     curs.execute("DELETE FROM minutes")
-    conn.commit()
     curs.close()
 
 def insert_minutes(conn):
-    curs = conn.cursor()
-
-    reader = csv.reader(open("Minutes_All.txt", 'rb'), delimiter='\t')
-    reader.next() # skip headers
-    for row in reader:
-        curs.execute('INSERT INTO minutes (Name, Location, Date, Minutes, \
-            Year, IsDenson, GoodCt, ErrCt, AmbCt, CorrCt, ProbCt, TotalCt, \
-            ProbPercent) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', row)
-
-    conn.commit()
-    curs.close()
+    sql = 'INSERT INTO minutes (%s) VALUES (%s)' % (', '.join(MINUTES_COLUMNS), ','.join('?' * len(MINUTES_COLUMNS)))
+    load_csv(conn, "Minutes_All.txt", range(len(MINUTES_COLUMNS)), sql, delimiter='\t')
 
 if __name__ == '__main__':
     db = util.open_db()
-    delete_minutes(db)
-    insert_minutes(db)
+    with util.bulk_load(db, indexes=()):
+        delete_minutes(db)
+        insert_minutes(db)
     db.close()
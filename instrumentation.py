@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+class Stats(object):
+    """Per-stage timings and counters for the parse/insert pipeline.
+
+    Stage times are kept both as totals and per minutes row (between
+    begin_minutes and end_minutes), so the slowest minutes can be reported.
+    Work done on behalf of many rows (eg. a batched insert) can be timed
+    with per_minutes=False, so it only counts towards the totals.
+    """
+
+    def __init__(self):
+        self.stages = defaultdict(float) # stage -> seconds
+        self.counts = defaultdict(int)   # counter -> count
+        self.minutes = []                # [{'id':, 'label':, 'seconds':, 'stages':}, ...]
+        self.current = None
+        self.started = time.time()
+
+    @contextmanager
+    def time(self, stage, per_minutes=True):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - start, per_minutes)
+
+    def add_time(self, stage, seconds, per_minutes=True):
+        self.stages[stage] += seconds
+        if per_minutes and self.current is not None:
+            self.current['stages'][stage] += seconds
+            self.current['seconds'] += seconds
+
+    def add_times(self, times):
+        # Merge stage times collected somewhere else (eg. a worker process)
+        for (stage, seconds) in times.iteritems():
+            self.add_time(stage, seconds)
+
+    def count(self, counter, n=1):
+        self.counts[counter] += n
+
+    def begin_minutes(self, minutes_id, label):
+        self.current = {'id': minutes_id, 'label': label, 'seconds': 0.0, 'stages': defaultdict(float)}
+        self.minutes.append(self.current)
+
+    def end_minutes(self):
+        self.current = None
+
+    def report(self, top=10):
+        slowest = sorted(self.minutes, key=lambda m: m['seconds'], reverse=True)[:top]
+        return {
+            'elapsed': time.time() - self.started,
+            'minutes': len(self.minutes),
+            'stages': dict(self.stages),
+            'counts': dict(self.counts),
+            'slowest': [dict(m, stages=dict(m['stages'])) for m in slowest],
+        }
+
+    def write_report(self, path, top=10, extra=None):
+        report = self.report(top)
+        if extra:
+            report.update(extra)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+        return report
+
+class NullStats(object):
+    # Stand-in for Stats when instrumentation is turned off
+
+    def time(self, stage, per_minutes=True):
+        return self
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+    def add_time(self, stage, seconds, per_minutes=True):
+        pass
+
+    def add_times(self, times):
+        pass
+
+    def count(self, counter, n=1):
+        pass
+
+    def begin_minutes(self, minutes_id, label):
+        pass
+
+    def end_minutes(self):
+        pass
+
+NULL_STATS = NullStats()
+
+def start_tracemalloc():
+    # tracemalloc is in the standard library from python 3.4, and available
+    # as the pytracemalloc backport before that.
+    try:
+        import tracemalloc
+    except ImportError:
+        print "tracemalloc is not available, not tracing memory"
+        return None
+    tracemalloc.start()
+    return tracemalloc
+
+def tracemalloc_report(tracemalloc, top=10):
+    if tracemalloc is None:
+        return None
+    (current, peak) = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return {
+        'current_bytes': current,
+        'peak_bytes': peak,
+        'top': [str(stat) for stat in snapshot.statistics('lineno')[:top]],
+    }
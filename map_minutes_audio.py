@@ -1,20 +1,12 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-import csv
 import util
+from csv_loader import load_csv
 
 def map_minutes_audio(conn):
-    curs = conn.cursor()
-
-    reader = csv.reader(open("minutes_audio.csv", 'rb'))
-    reader.next() # skip headers
-    for row in reader:
-        curs.execute("UPDATE minutes SET audio_url=? WHERE Name LIKE ? AND \
-            Date LIKE ?", (row[2], row[0], row[1]))
-
-    conn.commit()
-    curs.close()
+    load_csv(conn, "minutes_audio.csv", ['audio_url', 'Name', 'Date'],
+             "UPDATE minutes SET audio_url=? WHERE Name LIKE ? AND Date LIKE ?")
 
 if __name__ == '__main__':
     db = util.open_db()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import json
+import sqlite3
+import zlib
+from parsed_minutes import ParsedMinutes
+
+# Bump this whenever the stored format changes
+CACHE_FORMAT = 2
+
+class ParseCache(object):
+    """Persistent cache of parse_minutes results.
+
+    Results are keyed on (hash of the minutes text, parser_key), where
+    parser_key should change whenever the parser's output could (see
+    MinutesParser.config_hash), and stored as compressed json in a small
+    sqlite database. Once the cache grows past max_bytes the least recently
+    used entries are evicted.
+    """
+
+    def __init__(self, path='parse_cache.db', parser_key='', max_bytes=256 * 1024 * 1024):
+        self.parser_key = '%d:%s' % (CACHE_FORMAT, parser_key)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS parse_cache (
+                text_hash TEXT,
+                parser_key TEXT,
+                result BLOB,
+                size INTEGER,
+                last_used INTEGER,
+                PRIMARY KEY (text_hash, parser_key)
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS parse_cache_last_used ON parse_cache(last_used)")
+        (self.size, self.clock) = self.conn.execute("SELECT IFNULL(SUM(size), 0), IFNULL(MAX(last_used), 0) FROM parse_cache").fetchone()
+
+    def get(self, text_hash):
+        row = self.conn.execute("SELECT result FROM parse_cache WHERE text_hash=? AND parser_key=?",
+                                [text_hash, self.parser_key]).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.clock += 1
+        self.conn.execute("UPDATE parse_cache SET last_used=? WHERE text_hash=? AND parser_key=?",
+                          [self.clock, text_hash, self.parser_key])
+        return decode_result(row[0])
+
+    def put(self, text_hash, d):
+        data = encode_result(d)
+        self.clock += 1
+        curs = self.conn.cursor()
+        curs.execute("SELECT size FROM parse_cache WHERE text_hash=? AND parser_key=?", [text_hash, self.parser_key])
+        row = curs.fetchone()
+        if row:
+            self.size -= row[0]
+        curs.execute("INSERT OR REPLACE INTO parse_cache (text_hash, parser_key, result, size, last_used) VALUES (?,?,?,?,?)",
+                     [text_hash, self.parser_key, sqlite3.Binary(data), len(data), self.clock])
+        self.size += len(data)
+        curs.close()
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # Drop least recently used entries until we're back down to 3/4 of
+        # max_bytes, so we don't have to evict again on the very next put.
+        target = self.max_bytes * 3 / 4
+        curs = self.conn.cursor()
+        rows = curs.execute("SELECT text_hash, parser_key, size FROM parse_cache ORDER BY last_used").fetchall()
+        evicted = []
+        for (text_hash, parser_key, size) in rows:
+            if self.size <= target:
+                break
+            evicted.append((text_hash, parser_key))
+            self.size -= size
+        curs.executemany("DELETE FROM parse_cache WHERE text_hash=? AND parser_key=?", evicted)
+        self.evictions += len(evicted)
+        curs.close()
+
+    def clear(self):
+        self.conn.execute("DELETE FROM parse_cache")
+        self.size = 0
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def stats(self):
+        return "parse cache: %d hits, %d misses, %d evictions, %d bytes" % (self.hits, self.misses, self.evictions, self.size)
+
+def encode_result(d):
+    # ParsedMinutes -> compressed json
+    return zlib.compress(json.dumps(d.to_state(), separators=(',', ':')))
+
+def decode_result(data):
+    return ParsedMinutes.from_state(json.loads(zlib.decompress(data)))
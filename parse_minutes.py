@@ -2,7 +2,16 @@
 # encoding: utf-8
 
 import re
+import hashlib
+import itertools
+import argparse
+import multiprocessing
+import sqlite3
+from collections import defaultdict
 import util
+from parse_cache import ParseCache
+from parsed_minutes import ParsedMinutes, iter_leads
+from instrumentation import Stats, NULL_STATS, start_tracemalloc, tracemalloc_report
 
 bad_words = [
     'Chairman',
@@ -126,31 +135,65 @@ non_denson = [
     'ScH',
     'WB']
 
-def build_bad_words():
-    ss = ''
-    for s in bad_words:
-        ss += s + '|'
-    ss = ss[:-1]
-    return ss
-
-def build_non_denson():
-    ss = ''
-    for s in non_denson:
-        ss += r'\(' + s + r'\)|'
-    ss = ss[:-1]
-    return ss
-
-def parse_minutes(s, debug_print=False):
-    session_count = 0
-    sessions = re.split('RECESS|LUNCH',s)
-    d = []
-    for session in sessions:
-        session_count += 1
+def build_word_trie(words):
+    # Factor a list of literal words into a trie-shaped alternation, so that
+    # eg. Chair|Chairman|Chairs becomes Chair(?:...) and the regex engine only
+    # tests one branch per character instead of every word in turn.
+    # This is only used as a prefix test (inside a lookahead), so once a word
+    # ends there is no need to look at any longer words that share its prefix.
+    trie = {}
+    for word in words:
+        node = trie
+        for c in word:
+            if node.get('') is True:
+                break
+            node = node.setdefault(c, {})
+        else:
+            node.clear()
+            node[''] = True
+
+    def build(node):
+        if node.get('') is True:
+            return ''
+        branches = [re.escape(c) + build(node[c]) for c in sorted(node)]
+        if len(branches) == 1:
+            return branches[0]
+        return '(?:' + '|'.join(branches) + ')'
+    return build(trie)
+
+def build_bad_words(words=None):
+    if words is None:
+        words = bad_words
+    return build_word_trie(words)
+
+def build_non_denson(books=None):
+    if books is None:
+        books = non_denson
+    return '|'.join(r'\(' + s + r'\)' for s in books)
+
+# Tokens are plain (start, end, kind, text) tuples, since there are a lot
+# of them
+NAME = 'NAME'
+PAGE = 'PAGE'
+
+class MinutesParser(object):
+    """Parses minutes text into sessions of {'name': ..., 'song': ...} leads.
+
+    All patterns are compiled once in the constructor, so a single parser can
+    be reused across every minutes row.
+    """
+
+    def __init__(self, bad_words=bad_words, non_denson=non_denson, session_separators=('RECESS', 'LUNCH')):
+        self.bad_words = list(bad_words)
+        self.non_denson = list(non_denson)
+        self.session_separators = list(session_separators)
+
+        self.session_pattern = re.compile('|'.join(re.escape(s) for s in self.session_separators))
 
         # name_pattern = re.compile('(?<=Chairman\s)[A-Z]\.\s[A-Z]\.\s[A-Z]\w+|[A-Z]\.\s[A-Z]\.\s[A-Z]\w+|(?<=Chairman\s)[A-Z][\w]*?\s[A-Z][\w]*?\s[A-Z]\w+|(?<=Chairman\s)[A-Z][\w]*?\s[A-Z]\w+|[A-Z][\w]*?\s[A-Z][\w]*?\s[A-Z]\w+|[A-Z][\w]*?\s[A-Z]\w+');
-        name_pattern = re.compile(ur'''
+        self.name_pattern = re.compile(ur'''
             (\A|(?<=\s))
-            ((?!''' + build_bad_words() + ur''')
+            ((?!''' + build_bad_words(self.bad_words) + ur''')
             (?<!for\s)
             (
                 # Start with upper case...
@@ -160,126 +203,629 @@ def parse_minutes(s, debug_print=False):
             )
             ([\u00C0-\u024F\w’-]+|\.\s|\.)\s?|van\sden\s|Van\sden\s|van\sDen\s){2,5}
         ''', re.UNICODE | re.VERBOSE)
-        # pagenum_pattern = re.compile('[\[\{/](\d{2,3}[tb]?)[\]\}]')
-        pagenum_pattern = re.compile(r'[\[\{/\s](\d{2,3}[tb]?)([\]\}\s]|$)(?!' + build_non_denson() + r')')
-
-        dd = []
-        leaders = re.split(r'\v|called to order|\:\s|(?<=[^\.][^A-Z\]\}])\.(\s|\Z)|(?<=[\]\}”\)])[;\.\:]|;', session)  #double quotes!
-        for chunk in leaders:
-            if chunk and (len(chunk) > 2):
-                if debug_print: print chunk
-                songs = re.finditer(pagenum_pattern, chunk)
-                first_song = None
-                for song in songs:
-                    if not first_song:
-                        first_song = song
-                    pagenum = song.group(1)
-                    # print pagenum
-                    leaders = re.finditer(name_pattern, chunk)
-                    for leader in leaders:
-                        if leader.end() <= first_song.start()+1:
-                            name = leader.group(0)
-                            name = name.strip() # TODO: should be able to incorporate this into regex......
-                            dd.append({'name': name, 'song': pagenum})
-                            if debug_print: print '***name: ' + name + '\tsong: ' + pagenum
-                        # else:
-                            # print "%d %d"%(leader.end(), first_song.start())
-                if debug_print: print "---chunk----------"
-
-        d.append({'session': session_count, 'leaders': dd})
-        # print "---session----------"
-    # print d
-    return d
-
-LEADERS = {} # leader -> id
-SONGS = {}   # page -> id
-ALIASES = {} # alias -> name
-INVALID = set()
-def insert_minutes(conn, d, minutes_id, debug_print=False):
 
-    curs = conn.cursor()
-    # Seed dicts
-    if not SONGS:
-        for (id, page) in curs.execute("SELECT id, PageNum FROM songs"):
-            SONGS[page] = id
-        for (name, alias) in curs.execute("SELECT name, alias FROM leader_name_aliases"):
-            ALIASES[alias] = ALIASES.get(alias, name) # don't overwrite existing
-        for (name,) in curs.execute("SELECT name FROM leader_name_invalid"):
-            INVALID.add(name)
-
-    for session in d:
-        for leader in session['leaders']:
-
-            #get song_id
-            song_id = SONGS.get(leader['song'])
-            if not song_id:
-                if leader['song'][-1:] == 't' or leader['song'][-1:] == 'b':
-                    #check for song without "t" or "b"
-                    song_id = SONGS.get(leader['song'][0:-1])
-                else:
-                    #check for song on "top"
-                    song_id = SONGS.get(leader['song']+'t')
-                SONGS[leader['song']] = song_id # memoize this result
-            if not song_id:
-                print leader
-                print "\tno song id! %s"%(leader['song'])
-                continue
+        # pagenum_pattern = re.compile('[\[\{/](\d{2,3}[tb]?)[\]\}]')
+        self.pagenum_pattern = re.compile(r'[\[\{/\s](\d{2,3}[tb]?)([\]\}\s]|$)(?!' + build_non_denson(self.non_denson) + r')')
+
+        self.chunk_pattern = re.compile(r'\v|called to order|\:\s|(?<=[^\.][^A-Z\]\}])\.(\s|\Z)|(?<=[\]\}”\)])[;\.\:]|;')  #double quotes!
+
+    def config_hash(self):
+        # Changes whenever this parser's output could change: the patterns
+        # themselves (including all word lists), or PARSER_VERSION for changes
+        # to the code around them.
+        h = hashlib.sha1(str(PARSER_VERSION))
+        for pattern in (self.session_pattern, self.name_pattern, self.pagenum_pattern, self.chunk_pattern):
+            h.update(pattern.pattern.encode('utf-8') if isinstance(pattern.pattern, unicode) else pattern.pattern)
+            h.update('\0')
+        return h.hexdigest()
+
+    def tokenize(self, chunk):
+        # Yields NAME and PAGE tokens in offset order, scanning the chunk at
+        # most once with each pattern. Names after the first page number never
+        # lead anything, so the name scan stops there (and never starts at all
+        # for the many chunks without a page number).
+        pages = self.pagenum_pattern.finditer(chunk)
+        first_page = next(pages, None)
+        if first_page is None:
+            return
+        for m in self.name_pattern.finditer(chunk):
+            if m.start() >= first_page.start():
+                break
+            yield (m.start(), m.end(), NAME, m.group(0).strip()) # TODO: should be able to incorporate this strip into regex......
+        for m in itertools.chain([first_page], pages):
+            yield (m.start(), m.end(), PAGE, m.group(1))
+
+    def pair_tokens(self, tokens):
+        # Every name that comes before the first page number leads every page
+        # number in the chunk, eg. "Margaret Keeton and Bradley Allen [546], [402]"
+        # Returns [(name token, page token), ...]
+        names = []
+        pages = []
+        first_page = None
+        for token in tokens:
+            if token[2] is PAGE:
+                if first_page is None:
+                    first_page = token
+                pages.append(token)
+            elif first_page is None:
+                names.append(token)
+        if first_page is None:
+            return []
+        # The page number is allowed to start on the whitespace that ends a name
+        names = [name for name in names if name[1] <= first_page[0] + 1]
+        return [(name, page) for page in pages for name in names]
+
+    def iter_sessions(self, s, debug_print=False, stats=NULL_STATS):
+        # Yields [(offset of the name in s, name, page), ...] for each session
+        with stats.time('session_split'):
+            sessions = split_spans(self.session_pattern, s)
+        for (session_start, session) in sessions:
+            leads = []
+
+            with stats.time('chunk_split'):
+                leaders = split_spans(self.chunk_pattern, session)
+            for (chunk_start, chunk) in leaders:
+                if chunk and (len(chunk) > 2):
+                    if debug_print: print chunk
+                    with stats.time('match'):
+                        pairs = self.pair_tokens(self.tokenize(chunk))
+                    offset = session_start + chunk_start
+                    for (name, pagenum) in pairs:
+                        leads.append((offset + name[0], name[3], pagenum[3]))
+                        if debug_print: print '***name: ' + name[3] + '\tsong: ' + pagenum[3]
+                    if debug_print: print "---chunk----------"
+
+            # print "---session----------"
+            yield leads
+
+    def parse_compact(self, s, debug_print=False, stats=NULL_STATS):
+        p = ParsedMinutes()
+        for leads in self.iter_sessions(s, debug_print, stats):
+            session_count = p.add_session()
+            for (start, name, page) in leads:
+                # names never start with whitespace, so only the end moves when stripped
+                p.add_lead(session_count, start, start + len(name), name, page)
+        p.done()
+        return p
+
+    def parse(self, s, debug_print=False, stats=NULL_STATS):
+        # The original list of session dicts, built directly rather than
+        # through ParsedMinutes, which costs more than it saves here
+        return [{'session': i + 1, 'leaders': [{'name': name, 'song': page} for (start, name, page) in leads]}
+                for (i, leads) in enumerate(self.iter_sessions(s, debug_print, stats))]
+
+def split_spans(pattern, s):
+    # Like pattern.split(s), but returns [(offset, piece), ...], leaving out
+    # any groups captured by the pattern. None of our split patterns can
+    # match an empty string, which re.split would skip over.
+    spans = []
+    pos = 0
+    for m in pattern.finditer(s):
+        spans.append((pos, s[pos:m.start()]))
+        pos = m.end()
+    spans.append((pos, s[pos:]))
+    return spans
+
+DEFAULT_PARSER = MinutesParser()
 
-            #find leader by name if exists, create if not
-            name = leader['name']
+def parse_minutes(s, debug_print=False):
+    return DEFAULT_PARSER.parse(s, debug_print)
+
+def parse_minutes_compact(s):
+    return DEFAULT_PARSER.parse_compact(s)
+
+def parse_minutes_untimed(s):
+    # Same return value as parse_minutes_timed, with no timings
+    return parse_minutes_compact(s), None
+
+def parse_minutes_timed(s):
+    # Returns (ParsedMinutes, {stage: seconds}), for instrumented runs
+    stats = Stats()
+    d = DEFAULT_PARSER.parse_compact(s, stats=stats)
+    return d, dict(stats.stages)
+
+class LeaderResolver(object):
+    """Resolves parsed page numbers and names to song and leader ids.
+
+    All of the lookup tables are loaded in one go, and alias chains
+    (A -> B -> C) are collapsed up front so every name is a single dict
+    lookup.
+    """
+
+    def __init__(self, conn):
+        self.songs = {}      # page -> id
+        self.aliases = {}    # alias -> real name, after following every alias
+        self.invalid = set()
+        self.leaders = {}    # name -> id
+
+        for (id, page) in conn.execute("SELECT id, PageNum FROM songs"):
+            self.songs[page] = id
+
+        aliases = {}
+        for (name, alias) in conn.execute("SELECT name, alias FROM leader_name_aliases"):
+            aliases[alias] = aliases.get(alias, name) # don't overwrite existing
+        self.aliases = close_aliases(aliases)
+        self.alias_names = defaultdict(list) # real name -> [alias, ...]
+        for (alias, name) in self.aliases.iteritems():
+            self.alias_names[name].append(alias)
+
+        for (name,) in conn.execute("SELECT name FROM leader_name_invalid"):
+            self.invalid.add(name)
+
+        # Leaders from a previous run (incremental or single id parsing)
+        for (id, name) in conn.execute("SELECT id, name FROM leaders"):
+            self.leaders[name] = id
+
+    def song_id(self, page):
+        try:
+            return self.songs[page]
+        except KeyError:
+            if page[-1:] == 't' or page[-1:] == 'b':
+                #check for song without "t" or "b"
+                song_id = self.songs.get(page[0:-1])
+            else:
+                #check for song on "top"
+                song_id = self.songs.get(page+'t')
+            self.songs[page] = song_id # memoize this result
+            return song_id
+
+    def real_name(self, name, debug_print=False, stats=NULL_STATS):
+        # Returns the name this leader should be recorded as, or None if the
+        # name should be ignored
+        if name in self.invalid:
+            if debug_print: print "invalid name! %s"%(name)
+            stats.count('invalid_names')
+            return None
+
+        real_name = self.aliases.get(name)
+        if real_name:
+            if debug_print: print "replacing %s with %s"%(name, real_name)
+            stats.count('alias_substitutions')
+            name = real_name
+
+        if name == '?':
+            # marked as a "bad" name in the alias table so let's just ignore this altogether
+            stats.count('ignored_names')
+            return None
+
+        return name
+
+def close_aliases(aliases):
+    # Follow each alias chain to its end, so A -> B -> C becomes A -> C and
+    # B -> C. A chain that loops back on itself stops just before the loop.
+    closed = {}
+    for alias in aliases:
+        chain = [alias]
+        name = aliases[alias]
+        while name in aliases and name not in chain:
+            chain.append(name)
+            name = aliases[name]
+        if name in chain:
+            name = chain[-1]
+        closed[alias] = name
+    return closed
+
+class MinutesWriter(object):
+    """Buffers new leaders and song_leader_joins and writes them with
+    executemany once batch_size rows have built up (or on flush).
+
+    New leader ids are assigned here rather than by sqlite, so joins can
+    reference a leader before it has actually been inserted. They carry on
+    from the leaders AUTOINCREMENT sequence, so the id of a deleted leader
+    is never handed out again.
+    """
+
+    def __init__(self, conn, batch_size=5000, resolver=None, stats=NULL_STATS):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.stats = stats
+        create_leader_index(conn)
+        self.resolver = resolver or LeaderResolver(conn)
+        self.leaders = [] # [(id, name), ...]
+        self.joins = []   # [(song_id, leader_id, minutes_id), ...]
+        (max_id,) = conn.execute("""
+            SELECT MAX(IFNULL((SELECT MAX(id) FROM leaders), 0),
+                       IFNULL((SELECT seq FROM sqlite_sequence WHERE name='leaders'), 0))
+        """).fetchone()
+        self.next_leader_id = max_id + 1
+
+    def leader_id(self, name):
+        # Find leader by name if exists, create if not
+        leader_id = self.resolver.leaders.get(name)
+        if not leader_id:
+            leader_id = self.next_leader_id
+            self.next_leader_id += 1
+            self.leaders.append((leader_id, name))
+            self.resolver.leaders[name] = leader_id
+            self.stats.count('new_leaders')
+        return leader_id
+
+    def add_join(self, song_id, leader_id, minutes_id):
+        self.joins.append((song_id, leader_id, minutes_id))
+        if len(self.joins) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # A flush writes rows for many minutes, so it's timed as its own
+        # stage rather than charged to whichever minutes filled the batch.
+        with self.stats.time('db_flush', per_minutes=False):
+            curs = self.conn.cursor()
+            if self.leaders:
+                self.insert_leaders(curs)
+                self.leaders = []
+            if self.joins:
+                curs.executemany("INSERT INTO song_leader_joins (song_id, leader_id, minutes_id) VALUES (?,?,?)", self.joins)
+                self.joins = []
+            curs.close()
+
+    def insert_leaders(self, curs):
+        # Upsert against the unique leader name index: if someone else has
+        # already inserted one of these names, use their id instead of ours.
+        changes = self.conn.total_changes
+        curs.executemany("INSERT OR IGNORE INTO leaders (id, name) VALUES (?,?)", self.leaders)
+        if self.conn.total_changes - changes < len(self.leaders):
+            remap = {}
+            for (leader_id, name) in self.leaders:
+                row = curs.execute("SELECT id FROM leaders WHERE name=?", [name]).fetchone()
+                if row is None:
+                    # our id was taken by some other name
+                    curs.execute("INSERT INTO leaders (name) VALUES (?)", [name])
+                    row = (curs.lastrowid,)
+                if row[0] != leader_id:
+                    remap[leader_id] = row[0]
+                    self.resolver.leaders[name] = row[0]
+            self.leaders = [(remap.get(id, id), name) for (id, name) in self.leaders]
+            self.joins = [(song_id, remap.get(id, id), minutes_id) for (song_id, id, minutes_id) in self.joins]
+
+        curs.executemany("UPDATE leader_name_aliases SET leader_id=? WHERE name=?",
+                         [(leader_id, alias) for (leader_id, name) in self.leaders
+                          for alias in [name] + self.resolver.alias_names.get(name, [])])
+
+def create_leader_index(conn):
+    try:
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS leader_name_index ON leaders(name)")
+    except sqlite3.IntegrityError:
+        print "duplicate leader names, leaders may be duplicated until parse_minutes.py --full is run"
+
+def insert_minutes(conn, d, minutes_id, debug_print=False, writer=None):
+
+    flush = writer is None
+    if writer is None:
+        writer = MinutesWriter(conn)
+    resolver = writer.resolver
+    stats = writer.stats
+
+    for (name, page) in iter_leads(d):
+
+        #get song_id
+        with stats.time('song_id'):
+            song_id = resolver.song_id(page)
+        if not song_id:
+            print {'name': name, 'song': page}
+            print "\tno song id! %s"%(page)
+            stats.count('unknown_pages')
+            continue
 
-            if name in INVALID:
-                if debug_print: print "invalid name! %s"%(name)
+        with stats.time('leader_id'):
+            name = resolver.real_name(name, debug_print, stats)
+            if name is None:
                 continue
 
-            real_name = ALIASES.get(name)
-            if real_name:
-                if debug_print: print "replacing %s with %s"%(name, real_name)
-                name = real_name
+            leader_id = writer.leader_id(name)
 
-            if name is '?':
-                # marked as a "bad" name in the alias table so let's just ignore this altogether
-                continue
+        if song_id and leader_id and minutes_id:
+            writer.add_join(song_id, leader_id, minutes_id)
+        else:
+            print "problem?! %d %d %d"%(song_id, leader_id, minutes_id)
 
-            leader_id = LEADERS.get(name)
-            if not leader_id:
-                curs.execute("INSERT INTO leaders (name) VALUES (?)", [name])
-                leader_id = curs.lastrowid
-                curs.execute("UPDATE leader_name_aliases SET leader_id=? WHERE name=?", [leader_id, name])
-                LEADERS[name] = leader_id
+    if flush:
+        writer.flush()
 
-            if song_id and leader_id and minutes_id:
-                curs.execute("INSERT INTO song_leader_joins (song_id, leader_id, minutes_id) VALUES (?,?,?)", (song_id, leader_id, minutes_id))
-            else:
-                print "problem?! %d %d %d"%(song_id, leader_id, minutes_id)
+def read_minutes(conn, batch_size=500):
+    # Yields lists of at most batch_size (Minutes, Name, Date, id) rows, in id
+    # order, so the whole minutes table is never held in memory at once.
+    # Non-Denson minutes are skipped by the query, so their text is never
+    # fetched (or decoded) at all.
+    curs = conn.cursor()
+    last_id = -1
+    while True:
+        curs.execute("""
+            SELECT Minutes, Name, Date, id
+            FROM minutes
+            WHERE IFNULL(isDenson, 1) != 0 AND id > ?
+            ORDER BY id
+            LIMIT ?
+        """, [last_id, batch_size])
+        rows = curs.fetchall()
+        if not rows:
+            break
+        yield rows
+        last_id = rows[-1][3]
+    curs.close()
+
+# Bump this whenever a parser change should force every minutes row to be
+# re-parsed by an incremental run.
+PARSER_VERSION = 1
+
+def minutes_hash(s):
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+def create_parse_state(conn):
+    # minutes_id -> hash of the minutes text and parser version it was parsed with
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS minutes_parse_state (
+            minutes_id INTEGER PRIMARY KEY,
+            hash TEXT,
+            parser_version INTEGER
+        )
+    """)
+
+def read_parse_state(conn):
+    state = {}
+    for (minutes_id, hash, version) in conn.execute("SELECT minutes_id, hash, parser_version FROM minutes_parse_state"):
+        state[minutes_id] = (hash, version)
+    return state
+
+def create_resolve_state(conn):
+    # hash of everything besides the minutes text that decides which leaders
+    # the minutes resolve to, as of the last parse_all_minutes run
+    conn.execute("CREATE TABLE IF NOT EXISTS minutes_resolve_state (hash TEXT)")
+
+def resolve_hash(conn):
+    # Changes whenever re-resolving every minutes row could give different
+    # leaders: the parser config, or an edit to the alias or invalid name
+    # tables (eg. by create_aliases.py).
+    h = hashlib.sha1(DEFAULT_PARSER.config_hash())
+    for row in conn.execute("SELECT name, alias FROM leader_name_aliases ORDER BY name, alias"):
+        h.update(repr(row))
+    h.update('\0')
+    for row in conn.execute("SELECT name FROM leader_name_invalid ORDER BY name"):
+        h.update(repr(row))
+    return h.hexdigest()
+
+def read_resolve_state(conn):
+    row = conn.execute("SELECT hash FROM minutes_resolve_state").fetchone()
+    return row[0] if row else None
+
+def write_resolve_state(conn, hash):
+    conn.execute("DELETE FROM minutes_resolve_state")
+    conn.execute("INSERT INTO minutes_resolve_state (hash) VALUES (?)", [hash])
+
+def delete_minutes_joins(conn, minutes_ids):
+    util.record_stats_changes(conn, minutes_ids)
+    curs = conn.cursor()
+    curs.executemany("DELETE FROM song_leader_joins WHERE minutes_id=?", [(id,) for id in minutes_ids])
+    curs.executemany("DELETE FROM minutes_parse_state WHERE minutes_id=?", [(id,) for id in minutes_ids])
+    curs.close()
 
+def delete_unused_leaders(conn):
+    curs = conn.cursor()
+    curs.execute("DELETE FROM leaders WHERE id NOT IN (SELECT leader_id FROM song_leader_joins)")
+    if curs.rowcount > 0:
+        curs.execute("UPDATE leader_name_aliases SET leader_id=NULL WHERE leader_id NOT IN (SELECT id FROM leaders)")
     curs.close()
 
-def parse_all_minutes(conn):
+def link_aliases(conn, resolver):
+    # Points every alias row at the leader it resolves to now. The writer
+    # only links aliases of the leaders it creates, so this is needed when
+    # the aliases change under leaders that already exist.
     curs = conn.cursor()
+    curs.execute("UPDATE leader_name_aliases SET leader_id=NULL")
+    curs.executemany("UPDATE leader_name_aliases SET leader_id=? WHERE name=?",
+                     [(leader_id, alias) for (leader_id, name) in conn.execute("SELECT id, name FROM leaders").fetchall()
+                      for alias in [name] + resolver.alias_names.get(name, [])])
+    curs.close()
 
+def replace_minutes(conn, d, minutes_id, hash, replace=True, writer=None):
+    # Insert parsed minutes, replacing any joins from a previous parse
+    stats = writer.stats if writer else NULL_STATS
+    if replace:
+        with stats.time('db_write'):
+            delete_minutes_joins(conn, [minutes_id])
+    insert_minutes(conn, d, minutes_id, writer=writer)
+    with stats.time('db_write'):
+        conn.execute("INSERT OR REPLACE INTO minutes_parse_state (minutes_id, hash, parser_version) VALUES (?,?,?)",
+                     [minutes_id, hash, PARSER_VERSION])
+
+def open_cache(path='parse_cache.db'):
+    return ParseCache(path, DEFAULT_PARSER.config_hash())
+
+class ParsePool(object):
+    """Runs a parse function over minutes texts, in order, optionally spread
+    across worker processes and with a per-document time budget.
+
+    A runaway regex can't be interrupted from inside the process running it,
+    so with a time_budget every document is parsed in a worker process, and
+    a document that takes longer than time_budget seconds gets TIMED_OUT as
+    its result and the workers are restarted.
+    """
+
+    def __init__(self, workers=1, time_budget=None):
+        self.workers = max(workers, 1)
+        self.time_budget = time_budget
+        self.pool = None
+        if self.workers > 1 or time_budget:
+            self.pool = multiprocessing.Pool(self.workers)
+
+    def imap(self, f, texts):
+        if self.pool is None:
+            return itertools.imap(f, texts)
+        if not self.time_budget:
+            return self.pool.imap(f, texts, chunksize=16)
+        return self.imap_budget(f, list(texts))
+
+    def imap_budget(self, f, texts):
+        # chunksize=1 so the wait for each result is (close to) the time
+        # spent parsing just that document. We only start the clock once all
+        # the earlier documents are done, so a document may get somewhat
+        # more than its budget, but never less.
+        i = 0
+        while i < len(texts):
+            results = self.pool.imap(f, texts[i:], chunksize=1)
+            try:
+                while i < len(texts):
+                    result = results.next(self.time_budget)
+                    i += 1
+                    yield result
+            except multiprocessing.TimeoutError:
+                i += 1
+                self.restart()
+                yield TIMED_OUT
+
+    def restart(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = multiprocessing.Pool(self.workers)
+
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+TIMED_OUT = (None, None)
+
+def create_quarantine(conn):
+    # Minutes that took longer than the time budget to parse, for review
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS minutes_quarantine (
+            minutes_id INTEGER PRIMARY KEY,
+            hash TEXT,
+            parser_version INTEGER,
+            time_budget REAL,
+            reason TEXT
+        )
+    """)
+
+def quarantine_minutes(conn, minutes_id, hash, time_budget, writer):
+    # Drop any joins from a previous parse, and record the parse state so
+    # incremental runs don't keep retrying until the minutes are edited (or
+    # the parser changes).
+    with writer.stats.time('db_write'):
+        delete_minutes_joins(conn, [minutes_id])
+        conn.execute("INSERT OR REPLACE INTO minutes_quarantine (minutes_id, hash, parser_version, time_budget, reason) VALUES (?,?,?,?,?)",
+                     [minutes_id, hash, PARSER_VERSION, time_budget, 'parse took longer than %gs' % time_budget])
+        conn.execute("INSERT OR REPLACE INTO minutes_parse_state (minutes_id, hash, parser_version) VALUES (?,?,?)",
+                     [minutes_id, hash, PARSER_VERSION])
+    writer.stats.count('quarantined_minutes')
+
+def parse_many(texts, hashes, imap=itertools.imap, cache=None, timed=False):
+    # Parse a list of minutes texts, in order, only parsing cache misses.
+    # Returns [(parsed minutes, {stage: seconds} or None), ...], with stage
+    # times only for timed runs, and TIMED_OUT for documents that ran over
+    # a ParsePool's time budget.
+    if timed:
+        parse = parse_minutes_timed
+    else:
+        parse = parse_minutes_untimed
+    if cache is None:
+        return list(imap(parse, texts))
+    results = [(cache.get(hash), None) for hash in hashes]
+    misses = [i for (i, (d, times)) in enumerate(results) if d is None]
+    for i, (d, times) in itertools.izip(misses, imap(parse, [texts[i] for i in misses])):
+        if d is not None:
+            cache.put(hashes[i], d)
+        results[i] = (d, times)
+    return results
+
+def parse_all_minutes(conn, workers=1, incremental=False, cache=None, batch_size=5000, stats=None, time_budget=None):
     # 3928 - camp fasola 2012
     # 3542 - ireland
-    curs.execute("SELECT Minutes, Name, Date, id, isDenson FROM minutes")
-    rows = curs.fetchall()
-    for row in rows:
-
-        if row[4] == 0:
-            continue
-
-        print "%s on %s"%(row[1],row[2])
-
-        s = row[0]
-        d = parse_minutes(s)
-
-        minutes_id = row[3]
-        insert_minutes(conn, d, minutes_id)
 
-    conn.commit()
-    curs.close()
+    # In incremental mode only new minutes, edited minutes and minutes parsed
+    # by an older PARSER_VERSION are re-parsed.
+    create_parse_state(conn)
+    create_resolve_state(conn)
+    state = read_parse_state(conn) if incremental else {}
+    resolve = resolve_hash(conn)
+    if incremental and not state:
+        # Nothing to compare against (eg. the first run with parse state), so
+        # fall back to a full parse rather than duplicating existing joins.
+        print "no parse state found, parsing all minutes"
+        clear_minutes(conn)
+    relink = False
+    if incremental and state and read_resolve_state(conn) != resolve:
+        # Unchanged minutes could still resolve to different leaders, so
+        # re-insert every minutes row. Leaders (and their ids) are kept, and
+        # any that no longer lead anything are deleted at the end. Parse
+        # results are still cached, so this mostly costs inserts.
+        print "parser config or leader aliases changed, re-resolving all minutes"
+        clear_joins(conn)
+        state = {}
+        relink = True
+    create_quarantine(conn)
+    quarantined = set(id for (id,) in conn.execute("SELECT minutes_id FROM minutes_quarantine"))
+    seen = set()
+    parsed_ids = []
+    writer = MinutesWriter(conn, batch_size, stats=stats or NULL_STATS)
+
+    # Parsing is a pure function of the text, so it can be spread across a
+    # pool. imap keeps the results in order, so inserts (and leader ids) come
+    # out exactly the same as a serial run.
+    pool = ParsePool(workers, time_budget)
+
+    try:
+        for rows in read_minutes(conn):
+            todo = []
+            for row in rows:
+                minutes_id = row[3]
+                seen.add(minutes_id)
+                hash = minutes_hash(row[0])
+                if state.get(minutes_id) != (hash, PARSER_VERSION):
+                    todo.append((row, hash))
+
+            results = parse_many([row[0] for (row, hash) in todo], [hash for (row, hash) in todo], pool.imap, cache, timed=stats is not None)
+            for (row, hash), (d, times) in itertools.izip(todo, results):
+                print "%s on %s"%(row[1],row[2])
+
+                minutes_id = row[3]
+                if d is None:
+                    print "\tparse took longer than %gs, quarantined" % time_budget
+                    quarantine_minutes(conn, minutes_id, hash, time_budget, writer)
+                    continue
+                if minutes_id in quarantined:
+                    conn.execute("DELETE FROM minutes_quarantine WHERE minutes_id=?", [minutes_id])
+
+                writer.stats.begin_minutes(minutes_id, "%s on %s"%(row[1],row[2]))
+                if times:
+                    writer.stats.add_times(times)
+                replace_minutes(conn, d, minutes_id, hash, replace=minutes_id in state, writer=writer)
+                writer.stats.end_minutes()
+                parsed_ids.append(minutes_id)
+    finally:
+        pool.close()
+
+    writer.flush()
+    parsed = len(parsed_ids)
+
+    # Minutes that were deleted (or are no longer Denson)
+    removed = [id for id in state if id not in seen]
+    with writer.stats.time('db_write'):
+        delete_minutes_joins(conn, removed)
+        conn.executemany("DELETE FROM minutes_quarantine WHERE minutes_id=?", [(id,) for id in removed])
+        if state:
+            # (a full parse already logged that all stats changed)
+            util.record_stats_changes(conn, parsed_ids)
+        if incremental:
+            delete_unused_leaders(conn)
+        if relink:
+            link_aliases(conn, writer.resolver)
+        write_resolve_state(conn, resolve)
+    writer.stats.count('parsed_minutes', parsed)
+    writer.stats.count('removed_minutes', len(removed))
+
+    print "parsed %d minutes, removed %d minutes" % (parsed, len(removed))
+    if cache:
+        cache.commit()
+        print cache.stats()
+        writer.stats.count('cache_hits', cache.hits)
+        writer.stats.count('cache_misses', cache.misses)
+    with writer.stats.time('db_write'):
+        conn.commit()
 
-def parse_minutes_by_id(conn, minutes_id):
+def parse_minutes_by_id(conn, minutes_id, cache=None):
     curs = conn.cursor()
+    create_parse_state(conn)
 
     # 3928 - camp fasola 2012
     # 3542 - ireland
@@ -293,26 +839,80 @@ def parse_minutes_by_id(conn, minutes_id):
         print "%s on %s"%(row[1],row[2])
 
         s = row[0]
-        d = parse_minutes(s)
+        hash = minutes_hash(s)
+        (d, times) = parse_many([s], [hash], cache=cache)[0]
 
         minutes_id = row[3]
-        insert_minutes(conn, d, minutes_id)
+        replace_minutes(conn, d, minutes_id, hash)
+        util.record_stats_changes(conn, [minutes_id])
         conn.commit()
+        if cache:
+            cache.commit()
 
     curs.close()
 
+def clear_joins(conn):
+    # Like clear_minutes, but keeps the leaders, so their ids don't change
+    create_parse_state(conn)
+    curs = conn.cursor()
+    curs.execute("DELETE FROM song_leader_joins")
+    curs.execute("DELETE FROM minutes_parse_state")
+    util.record_all_stats_changed(conn)
+    curs.close()
+
 def clear_minutes(conn):
+    create_parse_state(conn)
+    create_resolve_state(conn)
     curs = conn.cursor()
     curs.execute("DELETE FROM leaders")
     curs.execute("DELETE FROM song_leader_joins")
+    curs.execute("DELETE FROM minutes_parse_state")
+    curs.execute("DELETE FROM minutes_resolve_state")
     curs.execute("DELETE FROM sqlite_sequence WHERE name='leaders'")
     curs.execute("DELETE FROM sqlite_sequence WHERE name='song_leader_joins'")
+    util.record_all_stats_changed(conn)
     conn.commit()
     curs.close()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='number of parser processes')
+    parser.add_argument('--full', action='store_true', help='clear all leaders and re-parse every minutes row')
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write parse_cache.db")
+    parser.add_argument('--batch-size', type=int, default=5000, help='number of song_leader_joins to insert at once')
+    parser.add_argument('--stats', metavar='FILE', help='write per-stage timings and counters to FILE as json')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest minutes to include in --stats')
+    parser.add_argument('--profile', metavar='FILE', help='run under cProfile and save the profile to FILE')
+    parser.add_argument('--tracemalloc', action='store_true', help='include tracemalloc memory statistics in --stats')
+    parser.add_argument('--time-budget', type=float, metavar='SECONDS', help='quarantine any minutes that take longer than this to parse')
+    args = parser.parse_args()
+
+    stats = Stats() if args.stats else None
+    tracemalloc = start_tracemalloc() if args.tracemalloc else None
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
     db = util.open_db()
-    clear_minutes(db)
-    parse_all_minutes(db)
-    # parse_minutes_by_id(db, 5165)
+    cache = None if args.no_cache else open_cache()
+    # A full rebuild inserts every song_leader_joins row, so build its
+    # indexes once at the end. Incremental runs need minutes_index to
+    # delete the joins of edited minutes, and keep the usual crash safety.
+    with util.bulk_load(db, indexes=util.SECONDARY_INDEXES if args.full else (), unsafe=args.full):
+        if args.full:
+            clear_minutes(db)
+        parse_all_minutes(db, args.workers, incremental=not args.full, cache=cache, batch_size=args.batch_size, stats=stats, time_budget=args.time_budget)
+    # parse_minutes_by_id(db, 5165, cache)
+    if cache:
+        cache.close()
     db.close()
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print "saved profile to %s" % args.profile
+    if stats:
+        stats.write_report(args.stats, args.top, {'tracemalloc': tracemalloc_report(tracemalloc, args.top)})
+        print "saved stats to %s" % args.stats
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from array import array
+from itertools import izip
+
+class ParsedMinutes(object):
+    """Compact result of parsing one minutes document.
+
+    Each lead is a row across a handful of arrays: its session number, the
+    [start, end) offsets of the leader's name in the original text, and
+    indexes into `names` and `pages`, which hold each distinct name and page
+    number only once. to_dicts() gives back the old
+    [{'session': 1, 'leaders': [{'name': ..., 'song': ...}]}] form.
+    """
+
+    __slots__ = ('session_count', 'names', 'pages', 'sessions', 'starts', 'ends', 'name_ids', 'page_ids', '_index')
+
+    def __init__(self):
+        self.session_count = 0
+        self.names = []             # distinct names
+        self.pages = []             # distinct page numbers
+        self.sessions = array('H')  # session number, from 1
+        self.starts = array('l')    # name offsets in the minutes text
+        self.ends = array('l')
+        self.name_ids = array('H')  # index into names
+        self.page_ids = array('H')  # index into pages
+        self._index = None          # ({name: index}, {page: index}), while building
+
+    def add_session(self):
+        self.session_count += 1
+        return self.session_count
+
+    def add_lead(self, session, start, end, name, page):
+        self.sessions.append(session)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.name_ids.append(self._intern(self.names, name))
+        self.page_ids.append(self._intern(self.pages, page))
+
+    def _intern(self, strings, s):
+        if self._index is None:
+            self._index = (dict((name, i) for (i, name) in enumerate(self.names)),
+                           dict((page, i) for (i, page) in enumerate(self.pages)))
+        index = self._index[0] if strings is self.names else self._index[1]
+        i = index.get(s)
+        if i is None:
+            i = index[s] = len(strings)
+            strings.append(s)
+        return i
+
+    def done(self):
+        # Drop the lookup table that's only needed while adding leads
+        self._index = None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def leads(self):
+        # Yields (name, page) for every lead, in order
+        names = self.names
+        pages = self.pages
+        for (name_id, page_id) in izip(self.name_ids, self.page_ids):
+            yield names[name_id], pages[page_id]
+
+    def spans(self):
+        # Yields (session, start, end, name, page) for every lead, in order
+        for (i, (name, page)) in enumerate(self.leads()):
+            yield self.sessions[i], self.starts[i], self.ends[i], name, page
+
+    def to_dicts(self):
+        d = [{'session': i + 1, 'leaders': []} for i in range(self.session_count)]
+        for (session, start, end, name, page) in self.spans():
+            d[session - 1]['leaders'].append({'name': name, 'song': page})
+        return d
+
+    def to_state(self):
+        # Plain lists, for pickling and json
+        return {
+            'session_count': self.session_count,
+            'names': self.names,
+            'pages': self.pages,
+            'leads': [list(lead) for lead in izip(self.sessions, self.starts, self.ends, self.name_ids, self.page_ids)],
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        p = cls()
+        p.__setstate__(state)
+        return p
+
+    def __getstate__(self):
+        return self.to_state()
+
+    def __setstate__(self, state):
+        self.session_count = state['session_count']
+        self.names = list(state['names'])
+        self.pages = list(state['pages'])
+        self._index = None
+        leads = state['leads']
+        self.sessions = array('H', [lead[0] for lead in leads])
+        self.starts = array('l', [lead[1] for lead in leads])
+        self.ends = array('l', [lead[2] for lead in leads])
+        self.name_ids = array('H', [lead[3] for lead in leads])
+        self.page_ids = array('H', [lead[4] for lead in leads])
+
+    def __eq__(self, other):
+        return isinstance(other, ParsedMinutes) and self.to_state() == other.to_state()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<ParsedMinutes: %d sessions, %d leads>' % (self.session_count, len(self))
+
+def iter_leads(d):
+    # Yields (name, page) from either a ParsedMinutes or the old list of dicts
+    if isinstance(d, ParsedMinutes):
+        return d.leads()
+    return ((leader['name'], leader['song']) for session in d for leader in session['leaders'])
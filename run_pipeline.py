@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+import util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = os.path.join(HERE, 'pipeline_state.json')
+DB_FILE = os.path.join(HERE, util.DB_PATH)
+SHADOW_FILE = DB_FILE + '.build'
+
+class Stage(object):
+    """One step of the pipeline.
+
+    A stage is re-run whenever its fingerprint changes. The fingerprint
+    covers its command, the contents of its input files, the row counts of
+    any tables it reads that no stage writes (eg. songs), and the
+    fingerprints of the stages it depends on, so a change anywhere upstream
+    re-runs everything downstream of it.
+
+    sqlite only allows one writer at a time, and most stages hold their
+    write lock for the whole run (eg. parse_minutes.py), so a stage that
+    writes the database runs on its own. Stages with short_writes only
+    hold the lock for a moment at a time (the crawls write and commit in
+    small batches), so they can run alongside each other, waiting on each
+    other's locks, but still never alongside a stage that holds it for long.
+    """
+
+    def __init__(self, name, command, files=(), tables=(), deps=(), cwd='.', writes_db=True, short_writes=False):
+        self.name = name
+        self.command = command
+        self.files = files
+        self.tables = tables
+        self.deps = deps
+        self.cwd = cwd
+        self.writes_db = writes_db
+        self.short_writes = short_writes
+
+    def input_files(self):
+        paths = []
+        for pattern in self.files:
+            matches = sorted(glob.glob(os.path.join(HERE, pattern)))
+            # keep a missing file in the list, so it still affects the fingerprint
+            paths.extend(matches or [os.path.join(HERE, pattern)])
+        return paths
+
+def python(script, *args):
+    return [sys.executable, script] + list(args)
+
+SCRAPY = ['scrapy', 'crawl', 'singing']
+LOADER_FILES = ('util.py', 'csv_loader.py')
+PARSER_FILES = ('parse_minutes.py', 'parse_cache.py', 'parsed_minutes.py', 'instrumentation.py', 'util.py')
+
+STAGES = [
+    Stage('insert_minutes', python('insert_minutes.py'),
+          files=('insert_minutes.py', 'Minutes_All.txt') + LOADER_FILES),
+    Stage('create_aliases', python('create_aliases.py'),
+          files=('create_aliases.py',
+                 'FaSoLa Minutes Corrections (Responses) - Form Responses.csv',
+                 'FaSoLa Minutes Corrections (Responses) - Invalid Names.csv') + LOADER_FILES),
+    Stage('parse_minutes', python('parse_minutes.py'),
+          files=PARSER_FILES, tables=('songs',), deps=('insert_minutes', 'create_aliases')),
+    Stage('create_leader_stats', python('create_leader_stats.py', '--delta'),
+          files=('create_leader_stats.py', 'util.py'), deps=('parse_minutes',)),
+    Stage('create_song_stats', python('create_song_stats.py', '--delta'),
+          files=('create_song_stats.py', 'util.py'), deps=('parse_minutes', 'insert_locations')),
+    Stage('create_leader_year_stats', python('create_leader_year_stats.py'),
+          files=('create_leader_year_stats.py', 'util.py'), deps=('parse_minutes',)),
+    Stage('create_song_neighbors', python('create_song_neighbors.py'),
+          files=('create_song_neighbors.py', 'util.py'), deps=('parse_minutes',)),
+    Stage('create_leader_similarity', python('create_leader_similarity.py'),
+          files=('create_leader_similarity.py', 'util.py'), deps=('create_leader_stats',)),
+    Stage('map_minutes_audio', python('map_minutes_audio.py'),
+          files=('map_minutes_audio.py', 'minutes_audio.csv') + LOADER_FILES, deps=('insert_minutes',)),
+    Stage('bostonsing', SCRAPY, cwd='bostonsing',
+          files=('spider_base.py', 'bostonsing/*.csv', 'bostonsing/bostonsing/*.py', 'bostonsing/bostonsing/spiders/*.py'),
+          tables=('songs',), deps=('parse_minutes', 'map_minutes_audio'), short_writes=True),
+    Stage('shapenotecds', SCRAPY, cwd='shapenotecds',
+          files=('spider_base.py', 'shapenotecds/*.csv', 'shapenotecds/shapenotecds/*.py', 'shapenotecds/shapenotecds/spiders/*.py'),
+          tables=('songs',), deps=('parse_minutes', 'map_minutes_audio'), short_writes=True),
+    Stage('phillysacredharp', SCRAPY, cwd='phillysacredharp',
+          files=('spider_base.py', 'phillysacredharp/*.csv', 'phillysacredharp/phillysacredharp/*.py', 'phillysacredharp/phillysacredharp/spiders/*.py'),
+          tables=('songs',), deps=('parse_minutes', 'map_minutes_audio'), short_writes=True),
+    Stage('insert_locations', python('insert_locations.py'),
+          files=('insert_locations.py', 'Singings Locations Fuzzy - locations_for_export.csv') + LOADER_FILES,
+          deps=('insert_minutes',)),
+    Stage('create_index', python('create_index.py'),
+          files=('create_index.py', 'util.py'),
+          deps=('create_leader_stats', 'create_song_stats', 'create_leader_year_stats', 'create_song_neighbors', 'create_leader_similarity',
+                'bostonsing', 'shapenotecds', 'phillysacredharp', 'insert_locations')),
+]
+
+def file_hash(path):
+    if not os.path.isfile(path):
+        return 'missing'
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), ''):
+            h.update(block)
+    return h.hexdigest()
+
+def table_fingerprint(conn, table):
+    if conn is None:
+        return 'missing'
+    try:
+        return '%d:%s' % conn.execute("SELECT COUNT(*), MAX(rowid) FROM %s" % table).fetchone()
+    except sqlite3.OperationalError:
+        return 'missing'
+
+def dependency_order(stages):
+    # stages, with every stage after the stages it depends on
+    by_name = dict((stage.name, stage) for stage in stages)
+    ordered = []
+    def visit(stage, path):
+        if stage in ordered:
+            return
+        if stage.name in path:
+            raise ValueError('dependency cycle: %s' % ' -> '.join(path + [stage.name]))
+        for dep in stage.deps:
+            visit(by_name[dep], path + [stage.name])
+        ordered.append(stage)
+    for stage in stages:
+        visit(stage, [])
+    return ordered
+
+def fingerprints(stages):
+    # stage name -> fingerprint
+    conn = sqlite3.connect(DB_FILE) if os.path.isfile(DB_FILE) else None
+    prints = {}
+    for stage in dependency_order(stages):
+        h = hashlib.sha1()
+        h.update(json.dumps([stage.command[1:], stage.cwd]))
+        for path in stage.input_files():
+            h.update('%s=%s\n' % (os.path.relpath(path, HERE), file_hash(path)))
+        for table in stage.tables:
+            h.update('table %s=%s\n' % (table, table_fingerprint(conn, table)))
+        for dep in stage.deps:
+            h.update('stage %s=%s\n' % (dep, prints[dep]))
+        prints[stage.name] = h.hexdigest()
+    if conn:
+        conn.close()
+    return prints
+
+def read_state():
+    if not os.path.isfile(STATE_FILE):
+        return {}
+    with open(STATE_FILE) as f:
+        return json.load(f)
+
+def write_state(state):
+    with open(STATE_FILE, 'w') as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+
+def stages_to_run(stages, prints, state, targets=None, force=()):
+    # Out of date stages, limited to targets and everything they depend on
+    by_name = dict((stage.name, stage) for stage in stages)
+    wanted = set()
+    todo = list(targets or by_name)
+    while todo:
+        name = todo.pop()
+        if name not in wanted:
+            wanted.add(name)
+            todo.extend(by_name[name].deps)
+    return [stage for stage in stages
+            if stage.name in wanted and (stage.name in force or state.get(stage.name) != prints[stage.name])]
+
+def can_run_with(stage, running):
+    # Whether stage can start alongside the running stages without one of
+    # them waiting too long on a database lock
+    if not stage.writes_db:
+        return True
+    writers = [other for other in running if other.writes_db]
+    if stage.short_writes:
+        return all(other.short_writes for other in writers)
+    return not writers
+
+def run_stages(stages, prints, state, jobs=1, dry_run=False, env=None, save_state=True):
+    # Runs stages as soon as everything they depend on (that also needs
+    # running) is done, up to `jobs` at a time, as long as their database
+    # writes can share the lock (see Stage). Returns the failed stages.
+    pending = list(stages)
+    names = set(stage.name for stage in stages)
+    by_name = dict((stage.name, stage) for stage in stages)
+    running = {}  # name -> (Popen, start time)
+    done = set()
+    failed = []
+    while pending or running:
+        for stage in list(pending):
+            if len(running) >= jobs:
+                break
+            blocked = [dep for dep in stage.deps if dep in names and dep not in done]
+            if any(dep in failed for dep in blocked):
+                print "skip %s (%s failed)" % (stage.name, ', '.join(d for d in blocked if d in failed))
+                pending.remove(stage)
+                failed.append(stage.name)
+            elif not can_run_with(stage, [by_name[name] for name in running]):
+                continue
+            elif not blocked:
+                pending.remove(stage)
+                print "run  %s: %s" % (stage.name, ' '.join(stage.command))
+                if dry_run:
+                    done.add(stage.name)
+                    continue
+                proc = subprocess.Popen(stage.command, cwd=os.path.join(HERE, stage.cwd), env=env)
+                running[stage.name] = (proc, time.time())
+
+        for (name, (proc, start)) in running.items():
+            if proc.poll() is None:
+                continue
+            del running[name]
+            if proc.returncode == 0:
+                print "done %s in %.1fs" % (name, time.time() - start)
+                done.add(name)
+                state[name] = prints[name]
+                if save_state:
+                    write_state(state)
+            else:
+                print "FAIL %s (exit code %d)" % (name, proc.returncode)
+                failed.append(name)
+        if running:
+            time.sleep(0.1)
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the out of date stages of the minutes pipeline')
+    parser.add_argument('targets', nargs='*', help='stages to bring up to date (default: all)')
+    parser.add_argument('--jobs', '-j', type=int, default=3, help='number of stages to run at once (only the crawls share the database with each other)')
+    parser.add_argument('--force', action='append', default=[], metavar='STAGE', help='run STAGE even if it is up to date')
+    parser.add_argument('--dry-run', '-n', action='store_true', help="print what would run, but don't run it")
+    parser.add_argument('--list', action='store_true', help='list the stages and whether they are up to date')
+    parser.add_argument('--shadow', action='store_true', help='build in a copy of the database, and only replace minutes.db if every stage succeeds and the copy passes sanity checks')
+    args = parser.parse_args()
+
+    names = [stage.name for stage in STAGES]
+    for name in args.targets + args.force:
+        if name not in names:
+            parser.error('unknown stage %s (stages: %s)' % (name, ', '.join(names)))
+
+    prints = fingerprints(STAGES)
+    state = read_state()
+    if args.list:
+        for stage in STAGES:
+            print "%-20s %s" % (stage.name, 'up to date' if state.get(stage.name) == prints[stage.name] else 'out of date')
+        sys.exit(0)
+
+    todo = stages_to_run(STAGES, prints, state, args.targets, args.force)
+    if not todo:
+        print "everything is up to date"
+        sys.exit(0)
+    if not args.shadow or args.dry_run:
+        failed = run_stages(todo, prints, state, args.jobs, args.dry_run)
+        sys.exit(1 if failed else 0)
+
+    # Build in a copy, so anyone reading minutes.db never sees half-built
+    # tables or waits on our locks
+    if os.path.isfile(DB_FILE):
+        util.copy_db(DB_FILE, SHADOW_FILE)
+    env = dict(os.environ, MINUTES_DB=SHADOW_FILE)
+    failed = run_stages(todo, prints, state, args.jobs, env=env, save_state=False)
+    if failed:
+        print "build failed, minutes.db is unchanged (partial build in %s)" % SHADOW_FILE
+        sys.exit(1)
+    problems = util.check_db(SHADOW_FILE, DB_FILE)
+    if problems:
+        for problem in problems:
+            print "check failed: %s" % problem
+        print "minutes.db is unchanged (rejected build in %s)" % SHADOW_FILE
+        sys.exit(1)
+    util.swap_db(SHADOW_FILE, DB_FILE)
+    write_state(state)
+    print "replaced minutes.db"
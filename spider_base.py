@@ -5,21 +5,73 @@ import difflib
 import os
 import re
 import csv
+import time
 
 class SpiderBase(scrapy.Spider):
+    # Write audio_url updates after this many rows, or this many seconds.
+    # Updates wait in memory until then, and are written and committed in
+    # one go, so the write lock is never held while waiting on the network
+    # and other pipeline steps aren't locked out for long.
+    commit_every = 5000
+    commit_seconds = 1.0
+
+    conn = None
+    song_ids = None
+    pending_updates = None
+    last_commit = 0
+
     def open_db(self):
-        # This is run in a subdirectory (bostonsing, or shapenotecds)
-        conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'minutes.db'))
+        # This is run in a subdirectory (bostonsing, or shapenotecds), and
+        # MINUTES_DB is an absolute path when run_pipeline.py sets it
+        conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), os.environ.get('MINUTES_DB', 'minutes.db')), timeout=60)
         conn.text_factory = str
         return conn
 
+    def get_db(self):
+        # One connection for the whole crawl
+        if self.conn is None:
+            self.conn = self.open_db()
+        return self.conn
+
+    def closed(self, reason):
+        if self.conn is not None:
+            self.write_updates()
+            self.conn.close()
+            self.conn = None
+
+    def write_updates(self):
+        if self.pending_updates:
+            conn = self.get_db()
+            conn.executemany("UPDATE song_leader_joins SET audio_url=? WHERE id=?", self.pending_updates)
+            conn.commit()
+        self.pending_updates = []
+        self.last_commit = time.time()
+
+    def load_song_ids(self):
+        # {PageNum: song id}, keeping the first song for each page
+        song_ids = {}
+        for (song_id, pagenum) in self.get_db().execute("SELECT id, PageNum FROM songs ORDER BY id"):
+            song_ids.setdefault(pagenum, song_id)
+        return song_ids
+
+    def song_id(self, pagenum):
+        # Looks up a page number, or its t/b variant (eg. 31 -> 31t, 31b -> 31)
+        if self.song_ids is None:
+            self.song_ids = self.load_song_ids()
+        if pagenum[-1:] in ('t', 'b'):
+            altpage = pagenum[:-1]
+        else:
+            altpage = pagenum + 't'
+        ids = [self.song_ids[p] for p in (pagenum, altpage) if p in self.song_ids]
+        return min(ids) if ids else None
+
     def start_requests(self):
         for url in self.get_audio_urls():
             if not self.parse_file(url):
                 yield self.make_requests_from_url(url)
 
     def get_audio_urls(self):
-        conn = self.open_db()
+        conn = self.get_db()
 
         # Build a query to get audio_urls from that are in allowed_domains
         domains = ['%' + d + '/%' for d in self.allowed_domains]
@@ -30,7 +82,6 @@ class SpiderBase(scrapy.Spider):
         for row in conn.execute(query, domains):
             urls.extend(row[0].split(','))
 
-        conn.close()
         return urls
 
     def parse_file(self, url):
@@ -56,7 +107,7 @@ class SpiderBase(scrapy.Spider):
 
     def parse_section(self, audio_url, song_data):
         self.logger.info("Parsing %s" % (audio_url))
-        conn = self.open_db()
+        conn = self.get_db()
         curs = conn.cursor()
 
         curs.execute(
@@ -66,6 +117,7 @@ class SpiderBase(scrapy.Spider):
         row = curs.fetchone()
         if not row:
             self.logger.error("no minutes found for audio_url: %s" % (audio_url))
+            curs.close()
             return
 
         minutes_id = row[0]
@@ -76,16 +128,8 @@ class SpiderBase(scrapy.Spider):
         urls = []
         for pagenum, url in song_data:
             pagenum = pagenum.lower()
-            altpage = ''
-            if pagenum[-1:] in ('t', 'b'):
-                altpage = pagenum[:-1]
-            else:
-                altpage = pagenum + 't'
-
-            curs.execute("SELECT id FROM songs WHERE PageNum IN (?, ?)", [pagenum, altpage])
-            row = curs.fetchone()
-            if row:
-                song_id = row[0]
+            song_id = self.song_id(pagenum)
+            if song_id is not None:
                 songs.append(song_id)
                 urls.append(url)
                 pages.append(pagenum)
@@ -105,14 +149,19 @@ class SpiderBase(scrapy.Spider):
 
         # get the longest subsequence from recordings and minutes
         s = difflib.SequenceMatcher(a=songs, b=minutes_songs)
+        updates = []
         last_a = 0
         for a, b, n in s.get_matching_blocks():
             for pagenum, url in zip(pages[last_a:a], urls[last_a:a]):
                 self.logger.warning("skip: %5s %s" % (pagenum, url))
             last_a = a+n
             for pagenum, url, join_ids in zip(pages[a:a+n], urls[a:a+n], minutes_ids[b:b+n]):
-                for id in join_ids:
-                    curs.execute("UPDATE song_leader_joins SET audio_url=? WHERE id=?", (url, id))
+                updates.extend((url, id) for id in join_ids)
                 self.logger.info("update: %5s %5r %s" % (pagenum, join_ids, url))
 
-        conn.commit()
+        curs.close()
+        if self.pending_updates is None:
+            self.pending_updates = []
+        self.pending_updates.extend(updates)
+        if len(self.pending_updates) >= self.commit_every or time.time() - self.last_commit >= self.commit_seconds:
+            self.write_updates()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import argparse
+import csv
+import re
+import time
+from collections import defaultdict
+import util
+
+# Same columns as the corrections form, so create_aliases.py can read the
+# output (it picks 'Uncorrected Name:', 'Correct Name:' and the typo column
+# by header name)
+HEADER = ['Timestamp', 'Uncorrected Name:', 'Correct Name:', 'Is this a typo or alternate spelling?', 'Notes:']
+
+def normalize(name):
+    # Lower case letters only, so "B. M. Smith" and "B.M. Smith" match
+    return re.sub(r'[\W\d_]+', '', name.lower(), flags=re.UNICODE)
+
+def ngrams(s, n=3):
+    s = '$' * (n - 1) + s + '$' * (n - 1)
+    return set(s[i:i + n] for i in range(len(s) - n + 1))
+
+def edit_distance(a, b, max_distance):
+    # Levenshtein distance, or max_distance + 1 if it's more than that. Only
+    # the cells within max_distance of the diagonal can stay under the
+    # limit, so the rest are never computed.
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    over = max_distance + 1
+    previous = [j if j <= max_distance else over for j in range(len(b) + 1)]
+    for (i, ca) in enumerate(a):
+        lo = max(0, i - max_distance)
+        hi = min(len(b), i + max_distance + 1)
+        current = [over] * (len(b) + 1)
+        if lo == 0:
+            current[0] = i + 1 if i < max_distance else over
+        for j in range(lo, hi):
+            current[j + 1] = min(previous[j + 1] + 1, current[j] + 1, previous[j] + (ca != b[j]), over)
+        if min(current[lo:hi + 1]) > max_distance:
+            return over
+        previous = current
+    return previous[-1]
+
+def candidate_pairs(names, max_distance=2, n=3):
+    # Yields (i, j, distance) for pairs of names whose normalized forms are
+    # within max_distance edits. Names are blocked on shared n-grams: one
+    # edit changes at most n n-grams, so a pair within max_distance shares at
+    # least (distinct n-grams in either name) - n * max_distance of them,
+    # and only pairs that do are compared. (Very short names can be within
+    # max_distance without sharing any n-grams, so those pairs are missed;
+    # names shorter than n are skipped altogether.)
+    #
+    # Only the n * max_distance + 1 rarest n-grams of each name are indexed:
+    # two names that share enough n-grams always share one of those, so
+    # nothing is lost, and common n-grams (mostly from common first names)
+    # never build up posting lists that pair everyone with everyone.
+    normalized = [normalize(name) for name in names]
+    grams = [ngrams(s, n) for s in normalized]
+    sizes = [len(name_grams) for name_grams in grams]
+    frequency = defaultdict(int)
+    for name_grams in grams:
+        for gram in name_grams:
+            frequency[gram] += 1
+    prefix_length = n * max_distance + 1
+    index = defaultdict(list)  # n-gram -> [name index, ...]
+    for (i, s) in enumerate(normalized):
+        if len(s) < n:
+            continue
+        rarest = sorted(grams[i], key=lambda gram: (frequency[gram], gram))[:prefix_length]
+        seen = set()
+        for gram in rarest:
+            for j in index[gram]:
+                if j in seen:
+                    continue
+                seen.add(j)
+                least = max(sizes[i], sizes[j]) - n * max_distance
+                if min(sizes[i], sizes[j]) < least or len(grams[i] & grams[j]) < least:
+                    continue
+                distance = edit_distance(s, normalized[j], max_distance)
+                if distance <= max_distance:
+                    yield j, i, distance
+        for gram in rarest:
+            index[gram].append(i)
+
+def read_leaders(conn):
+    # Returns ([(id, name, lead_count), ...], {leader_id: set(minutes_id)},
+    # {minutes_id: singing name})
+    leaders = conn.execute("SELECT id, name, lead_count FROM leaders ORDER BY id").fetchall()
+    minutes = defaultdict(set)
+    for (leader_id, minutes_id) in conn.execute("SELECT DISTINCT leader_id, minutes_id FROM song_leader_joins"):
+        minutes[leader_id].add(minutes_id)
+    singings = dict(conn.execute("SELECT id, Name FROM minutes"))
+    return leaders, minutes, singings
+
+def suggest_aliases(conn, max_distance=2):
+    # Returns [(score, alias, name, type, notes), ...], best first. The
+    # rarer name of each pair is the suggested alias. A typo never shows up
+    # in the same minutes as the real name, so pairs that do are two
+    # different people and are left out. The rest are ranked by name
+    # similarity and co-occurrence: a typo usually shows up at the same
+    # singings (by name, in any year) as the real name.
+    (leaders, minutes, singings) = read_leaders(conn)
+    suggestions = []
+    for (i, j, distance) in candidate_pairs([name for (id, name, count) in leaders], max_distance):
+        (a, b) = sorted([leaders[i], leaders[j]], key=lambda leader: (leader[2] or 0, -leader[0]))
+        (a_minutes, b_minutes) = (minutes.get(a[0], set()), minutes.get(b[0], set()))
+        if not a_minutes.isdisjoint(b_minutes):
+            continue
+        a_singings = set(singings.get(id) for id in a_minutes)
+        b_singings = set(singings.get(id) for id in b_minutes)
+        shared = len(a_singings & b_singings)
+        overlap = float(shared) / len(a_singings) if a_singings else 0.0
+
+        similarity = 1 - float(distance) / max(len(normalize(a[1])), len(normalize(b[1])), 1)
+        score = similarity * (0.5 + 0.5 * overlap)
+        type = 'Typo' if distance > 0 else 'Alternate Spelling'
+        notes = 'score %.3f; distance %d; leads %d/%d; shared singings %d/%d' % (
+            score, distance, a[2] or 0, b[2] or 0, shared, len(a_singings))
+        suggestions.append((score, a[1], b[1], type, notes))
+    suggestions.sort(key=lambda s: (-s[0], s[1]))
+    return suggestions
+
+def write_suggestions(path, suggestions):
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        for (score, alias, name, type, notes) in suggestions:
+            writer.writerow(['suggested', alias.encode('utf-8'), name.encode('utf-8'), type, notes])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Suggest leader name aliases for names that are probably typos of each other')
+    parser.add_argument('--max-distance', type=int, default=2, help='most letters two names can differ by')
+    parser.add_argument('--out', default='leader_alias_suggestions.csv', help='suggestions file, in the corrections form layout')
+    args = parser.parse_args()
+
+    start = time.time()
+    db = util.open_db()
+    suggestions = suggest_aliases(db, args.max_distance)
+    db.close()
+    write_suggestions(args.out, suggestions)
+    print "%d suggestions in %.1fs, saved to %s" % (len(suggestions), time.time() - start, args.out)
+    for (score, alias, name, type, notes) in suggestions[:10]:
+        print (u"  %-30s -> %-30s %s" % (alias, name, notes)).encode('utf-8')
@@ -1,11 +1,63 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import argparse
+import io
+import json
+import os
+import re
+import sys
 import util
 from parse_minutes import parse_minutes
 from parse_minutes import insert_minutes
 
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXPECTED_FILE = os.path.join(HERE, 'test_parse_minutes_expected.json')
+
+def sample_minutes():
+    # The sample minutes that are commented out below
+    with io.open(os.path.join(HERE, 'test_parse_minutes.py'), encoding='utf-8') as f:
+        return re.findall(r'^\s*# s = "(.*)"\s*$', f.read(), re.MULTILINE)
+
+def sample_leads():
+    # [[sample number, session, [[name, song], ...]], ...] for every session
+    # of every sample
+    leads = []
+    for (i, s) in enumerate(sample_minutes()):
+        for session in parse_minutes(s):
+            leads.append([i, session['session'], [[leader['name'], leader['song']] for leader in session['leaders']]])
+    return leads
+
+def save_expected(path=EXPECTED_FILE):
+    # One session per line, so a diff shows which sessions changed
+    leads = sample_leads()
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(u'[\n' + u',\n'.join(json.dumps(session, ensure_ascii=False) for session in leads) + u'\n]\n')
+    print "saved %d sessions to %s" % (len(leads), path)
+
+def test_sample_minutes():
+    # The leads found in each sample session should match the saved
+    # output (rerun with --save-expected after an intended change)
+    with io.open(EXPECTED_FILE, encoding='utf-8') as f:
+        expected = json.load(f)
+    actual = sample_leads()
+    for (want, got) in zip(expected, actual):
+        assert got == want, "sample %d session %d: expected %r, got %r" % (want[0], want[1], want[2], got[2])
+    assert len(actual) == len(expected), "expected %d sessions, got %d" % (len(expected), len(actual))
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the leaders parse_minutes finds in one minutes row, or check the sample minutes')
+    parser.add_argument('--check', action='store_true', help='compare the sample minutes with test_parse_minutes_expected.json')
+    parser.add_argument('--save-expected', action='store_true', help='save the current sample minutes output as the expected output')
+    args = parser.parse_args()
+    if args.save_expected:
+        save_expected()
+        sys.exit(0)
+    if args.check:
+        test_sample_minutes()
+        print "%d sample minutes ok" % len(sample_minutes())
+        sys.exit(0)
+
     # s = "The 46th session of the annual Sacred Harp singing at Liberty Church, in Winston County, was called to order by Billy Williams leading song on page [33b]. Prayer by Kenneth Handcock. Billy Williams then led {72} and leaders were called as follows: Alpha Black [318], [345b]; Corene White {73}, [379]; Stella Pratt {147}, [460]; Aubrey Tyree [358], [298], [434]; L. E. Hannah [147b], [455], [400]; Eron White [37b], [36b], [146]; B. B. Mattox [421] for Unie B. Howard who is ill, [217], [168]; Reedie Powell [200], [300], [269].RECESSThe class resumed singing with Billy Williams leading [410t]. The class was organized by electing the following officers: Chairman - Billy Williams; Vice Chairman - Ted Godsey; Arranging Committee - Travis Keeton; Secretary - Alpha Black. Leaders: Mae Conwill [270], [75], [99]; Carmon Brothers [101t], [207], {74}, for Ervin Brothers “That Beautiful Land”; Lola Roberson [475], [222]; John Hocutt [321b//321], [33t]; Elmer Conwill {448}.LUNCHThe class was called back by the Chairman, Billy Williams, leading song on page [127]. Leaders: Margaret Keeton and Bradley Allen [546], [402], [385b]; Josie Hyde [183], [428], [196]; Ester Brown [436], [317b//317]; John Hyde [39b], [63], {68}; Ada Godsey [59], [482], [301]; Elmer Conwill [142], {275}; Amanda Denson [186], [273]; Charley McCoy [280], [306], [198]; Ted Godsey [236], [408]; Blanton Adair [335], [339]; James Denson [224], [211], [358]; Alma Tyree, Viola Tyree, Bertha Wilson, Reedie Powell, James Denson, Amanda Denson, Roy Cleghorn, Blanton Adair, Jerry Parrish, Ruth Parrish, and Aubrey Tyree [358]; Travis Keeton [57], [56t], [225t]. Billy Williams [231], Aubrey Tyree 20b; Charley McCoy [36b]; Billy Williams [290]. The closing prayer was led by Aubrey Tyree.Chairman - Billy Williams; Vice Chairman - Ted Godsey; Secretary - Alpha Black."
     # s = "The seventh session of the Birthday Singing was held at Antioch Baptist Church on Friday night before the second Sunday in April. Birthday honorees were Mildred Johnson who celebrated her 90th birthday and Elder Homer Benefield who celebrated his 78th birthday this year.The class was called to order by Johnny Wright leading song on page [59]. The evening prayer was led by Felton Denney. Johnny Wright led song on page [335].The class organized with the following officers re-elected to serve: Chairman - Johnny Wright; Vice Chairman - Everette Ellis; Secretary - Charlene Wallace; Arranging Committee - Mary Florence Smith.Leaders: Jimmie Denney [123t]; Alice Edwards [104]; Charlene Wallace [84] (for I.V. McWhorter); Mary Florence Smith [63] (in memory of Florence Williams); Mildred Johnson [560]; Elder Homer Benefield {56}; Everette Ellis [62]; Ed Stevens [66]; Martha Beverly [146]; Josephine Denney [143]; Henry Schuman {32}; Roy Nelson [283]; Tom Ostwald [268]; Jan House [361]; Bill Beverly {29}; Felton Denney {73}; Louise Nelson [350]; Lonnie Rogers [225t]; Teenie Moody [73b].Rev. Tommy McGuire, pastor of the church, welcomed everyone. The blessing for the meal was offered by Rev. Tommy McGuire. The class was dismissed for one hour.RECESSThe class resumed singing with Johnny Wright leading song on page [294]. Leaders: Elder Neal Prichard [566]; the class sang “Happy Birthday” to Elder Homer Benefield and Mildred Johnson; Lou Cotney [218]; Elder Lewis Norton [45t]; Myron House [297]; Hugh McGraw [527] (by request); Everette Denney [405]; Evelyn Harris {47}; B.J. Harris [503]; Elsie Brock [460]; Mildred Johnson, Daphene Ray, and Diane Clayton [358]; Cindy Kissee [312b]; Mildred Patterson [119]; Matt Wells [49b]; Steven Schmidgall [496]; Charlie Obert {31}; Tom Ostwald [269]; Henry Schuman [480]; Martha Beverly [430]; Ed Stevens [300]; Bill Beverly [86]; Roy Nelson [434]; Lonnie Rogers [101t]; Charlie Obert [236].Announcements were made. Johnny Wright led song on page [46] as the closing song. Elder Homer Benefield dismissed the class with prayer.We were honored to have singers present from the states of: Alabama, Georgia, New Mexico, Michigan, California, and Minnesota.Chairman - Johnny Wright; Vice Chairman - Everette Ellis; Secretary - Charlene Wallace."
     # s = "The annual DeLong-Roberts Memorial Singing was opened with Vice Chairman Jesse Roberts leading [138b]. The morning prayer was offered by Henry Johnson.Leaders: Jesse Roberts [57]; John Plunkett [435], [541]; Tony Hammock [400], [75]; Matt DeLong [288]; Helen Bryson [172], [328]; Frances Mary D’Andrea [384],[148]; Jack Paulk [569b], [565]; Ed Thacker [176b], [48t]; Jeremy Shipp [260]; Lisa Grayson [201], [192]; Lonnie Rogers [389], [141]; Jeannette DePoy [142], [99]; Rachel Carlisle [145t], [204].RECESSRichard DeLong called the class to order leading [77t].A business session was held with the following officers elected or appointed to serve: Chairman--Richard DeLong; Vice Chairmen--Matt DeLong and Jesse Roberts; Secretary/Treasurer--Helen Bryson.Leaders: Jane Spencer [335], [564]; Jason Hollis [72b], [155]; Judy Chambless [339], [415]; Scott DePoy [448t], [277]; Erica Hinton [29b], [81t]; Karleen Williams [168], [45t]; Brady DeLong [37b], [61]; Cecil Roberts [491], [30b]; Micah Roberts [354b].LUNCHJesse Roberts called the class to order leading [137]. Leaders: Robert Chambless [145b]; Lisa Webb [222]; Claudia Egelhoff [556]; Bentley McGuire [153]; Ashley Roberts [196]; Matt Hinton [186]; Jonathan Smith [282]; Henry Johnson [539]; Judy Mincey [538]; Malinda Snow [344]; Janice Paulk [518]; Stanley Edwards and Marilyn Bradley [503], [528]; Andy Morse [183]; Oscar McGuire [441]; Jessica Altman [542]; Jean Payne [480]; Faye Hollis [340]; Ted Mercer [151]; Mark Puckett [454].RECESSJesse Roberts called the class to order leading [47t].John Plunkett conducted the memorial lesson and led [465] for the following deceased: Sherri Edwards and Mary Morse--Georgia; Alice Edwards--Alabama; Dean Slaton--Indiana.Helen Bryson led [475] for the following sick and shut-ins: Richard DeLong, Shirley Hardy, Irvin Roberts, Nora Roberts, Violet Thomason, Loy Garrison, Dorothy Garrison, and Shelbie Sheppard. Richard DeLong led [318] for all the DeLong and Roberts families who have been instrumental in leaving a rich legacy for us to follow. Henry Johnson closed the memorial lesson with prayer.Leaders: Sheri Taylor [209]; Claudia Egelhoff [474]; Lisa Grayson [370]; Jonathan Smith [312b]; Ashley Roberts [347]; Jessica Altman and Jesse Roberts [112]; Ed Thacker and Tony Hammock [494]; Frances Mary D’Andrea [532]; Ted Mercer [123b]; Matt DeLong and Richard DeLong [34t] (by request).The Locating Committee, Janice Paulk, John Plunkett, and Jesse Roberts, reported on possible locations for the singing to be held next year. Those discussed were Sweetwater Chapel, Antioch Primitive Baptist Church, and Emmaus Primitive Baptist Church. It was decided on Sweetwater Chapel (depending on its availability) for the singing in 2007; Antioch Primitive Baptist Church in 2008, with Emmaus Primitive Baptist Church as an alternate choice. The committee will have a final determination by the end of July.Announcements were made. Richard DeLong, Matt DeLong, and Jesse Roberts led [323t] for the closing song. John Plunkett dismissed the class with prayer.Chairman--Richard DeLong; Vice Chairmen--Matt DeLong and Jesse Roberts; Secretary/Treasure--Helen Bryson."
@@ -1,9 +1,182 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import os
+import shutil
 import sqlite3
+from contextlib import contextmanager
 
-def open_db():
-    conn = sqlite3.connect("minutes.db")
+# Scripts write to MINUTES_DB instead of minutes.db when it's set (see
+# run_pipeline.py --shadow)
+DB_PATH = os.environ.get('MINUTES_DB', 'minutes.db')
+SHADOW_BUILD = 'MINUTES_DB' in os.environ
+
+# Tables that should never shrink much in a rebuild
+CHECKED_TABLES = ['minutes', 'songs', 'leaders', 'song_leader_joins', 'leader_song_stats', 'song_stats', 'locations']
+
+# Secondary indexes on song_leader_joins: (name, table(columns))
+SECONDARY_INDEXES = [
+    ('song_index', 'song_leader_joins(song_id)'),
+    ('leader_index', 'song_leader_joins(leader_id)'),
+    ('minutes_index', 'song_leader_joins(minutes_id)'),
+]
+
+# Settings for loading lots of rows at once
+BULK_PRAGMAS = [
+    ('temp_store', 'MEMORY'),
+    ('cache_size', '-200000'),  # 200MB
+]
+
+# A crash with these set can corrupt the whole database, so they're only
+# used when that doesn't matter: a shadow build (which is just thrown away),
+# or a full rebuild someone asked for.
+UNSAFE_PRAGMAS = [
+    ('synchronous', 'OFF'),
+    ('journal_mode', 'MEMORY'),
+]
+
+def open_db(path=None):
+    # wait on locks, since run_pipeline.py can run several scripts at once
+    conn = sqlite3.connect(path or DB_PATH, timeout=60)
     conn.text_factory = lambda x: unicode(x, 'utf-8')
     return conn
+
+def copy_db(src, dst):
+    # Copies src to dst while holding a read lock, so no one can write to
+    # src in the middle of the copy
+    conn = sqlite3.connect(src, timeout=60)
+    try:
+        conn.execute("BEGIN")
+        conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        shutil.copyfile(src, dst)
+    finally:
+        conn.rollback()
+        conn.close()
+
+def table_counts(conn, tables=CHECKED_TABLES):
+    # {table: row count} for the tables that exist
+    existing = set(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+    return dict((table, conn.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0])
+                for table in tables if table in existing)
+
+def check_db(path, live_path, min_ratio=0.9):
+    # Sanity checks for a rebuilt database before it replaces live_path.
+    # Returns a list of problems (empty if it's fine to use).
+    conn = sqlite3.connect(path)
+    problems = [row[0] for row in conn.execute("PRAGMA integrity_check") if row[0] != 'ok']
+    counts = table_counts(conn)
+    conn.close()
+    if not os.path.isfile(live_path):
+        return problems
+    live = sqlite3.connect(live_path, timeout=60)
+    live_counts = table_counts(live)
+    live.close()
+    for (table, live_count) in sorted(live_counts.items()):
+        count = counts.get(table)
+        if count is None:
+            problems.append("%s is missing" % table)
+        elif count < live_count * min_ratio:
+            problems.append("%s has %d rows, down from %d" % (table, count, live_count))
+    return problems
+
+def swap_db(path, live_path):
+    # Atomically replaces live_path with path. Connections that are already
+    # open keep reading the old file; new ones get the new file.
+    os.rename(path, live_path)
+
+def drop_indexes(conn, indexes=SECONDARY_INDEXES):
+    for (name, on) in indexes:
+        conn.execute("DROP INDEX IF EXISTS %s" % name)
+    conn.commit()
+
+def create_indexes(conn, indexes=SECONDARY_INDEXES):
+    for (name, on) in indexes:
+        conn.execute("CREATE INDEX IF NOT EXISTS %s ON %s" % (name, on))
+    conn.commit()
+
+def set_pragmas(conn, pragmas):
+    # Returns the old values
+    old = []
+    for (name, value) in pragmas:
+        old.append((name, conn.execute("PRAGMA %s" % name).fetchone()[0]))
+        conn.execute("PRAGMA %s=%s" % (name, value))
+    return old
+
+@contextmanager
+def bulk_load(conn, indexes=SECONDARY_INDEXES, unsafe=False):
+    """Context manager for loading a lot of rows quickly.
+
+    Uses a bigger cache, and drops `indexes` so they are built once at the
+    end instead of being updated on every insert. Syncing and the on-disk
+    journal are also turned off for shadow builds, or when `unsafe` is set.
+    The indexes and the old settings are put back even if loading fails
+    (after rolling back whatever wasn't committed).
+    """
+    conn.commit()
+    pragmas = BULK_PRAGMAS
+    if unsafe or SHADOW_BUILD:
+        pragmas = BULK_PRAGMAS + UNSAFE_PRAGMAS
+    old = set_pragmas(conn, pragmas)
+    try:
+        drop_indexes(conn, indexes)
+        yield conn
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        create_indexes(conn, indexes)
+        set_pragmas(conn, old)
+
+def create_stats_changes(conn):
+    # Log of the (leader_id, song_id, year)s whose song_leader_joins changed,
+    # for updating stats incrementally. A row of NULLs means everything
+    # changed. stats_state has the last change each stats script has seen.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            leader_id INTEGER,
+            song_id INTEGER,
+            year INTEGER
+        )
+    """)
+    conn.execute("CREATE TABLE IF NOT EXISTS stats_state (name TEXT PRIMARY KEY, last_change INTEGER)")
+
+def record_stats_changes(conn, minutes_ids):
+    # Logs the current song_leader_joins of minutes_ids (call this before
+    # deleting joins, and after inserting them)
+    create_stats_changes(conn)
+    conn.executemany("""
+        INSERT INTO stats_changes (leader_id, song_id, year)
+        SELECT DISTINCT leader_id, song_id, minutes.Year
+        FROM song_leader_joins
+        LEFT JOIN minutes ON song_leader_joins.minutes_id = minutes.id
+        WHERE minutes_id=?
+    """, [(id,) for id in minutes_ids])
+
+def record_all_stats_changed(conn):
+    create_stats_changes(conn)
+    conn.execute("INSERT INTO stats_changes (leader_id, song_id, year) VALUES (NULL, NULL, NULL)")
+
+def read_stats_changes(conn, name):
+    # Returns (last change id, [(leader_id, song_id, year), ...]) with the
+    # changes since `name` last ran, or (last change id, None) if it needs a
+    # full rebuild.
+    create_stats_changes(conn)
+    # (from sqlite_sequence, since seen changes may already be deleted)
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='stats_changes'").fetchone()
+    last = row[0] if row else 0
+    row = conn.execute("SELECT last_change FROM stats_state WHERE name=?", [name]).fetchone()
+    if row is None:
+        return last, None
+    changes = conn.execute("SELECT DISTINCT leader_id, song_id, year FROM stats_changes WHERE id > ? AND id <= ?",
+                           [row[0], last]).fetchall()
+    if any(leader_id is None for (leader_id, song_id, year) in changes):
+        return last, None
+    return last, changes
+
+def finish_stats_changes(conn, name, last_change):
+    # Records that `name` is up to date with last_change, and drops changes
+    # every stats script has seen
+    conn.execute("INSERT OR REPLACE INTO stats_state (name, last_change) VALUES (?, ?)", [name, last_change])
+    conn.execute("DELETE FROM stats_changes WHERE id <= (SELECT MIN(last_change) FROM stats_state)")